@@ -0,0 +1,107 @@
+"""Compare the key-based yield points with their Future-based versions in
+:mod:`yieldpoints.futures`.
+
+Register n callback keys or n Futures, complete them in a random order, and
+drain them one at a time.
+
+    python benchmark/futures.py 1000 10000
+"""
+
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+# Import yieldpoints from this checkout, wherever the script is run from.
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yieldpoints
+from yieldpoints import futures
+
+
+def drain_keys(n, wait_any_class):
+    @gen.coroutine
+    def f():
+        callbacks = []
+        for key in range(n):
+            callbacks.append((yield gen.Callback(key)))
+
+        order = list(range(n))
+        random.shuffle(order)
+        for key in order:
+            IOLoop.current().add_callback(callbacks[key])
+
+        if wait_any_class is yieldpoints.AsCompleted:
+            completed = yieldpoints.AsCompleted(range(n))
+            while completed:
+                yield completed
+        else:
+            pending = set(range(n))
+            while pending:
+                key, result = yield yieldpoints.WaitAny(pending)
+                pending.remove(key)
+
+    return f
+
+
+def drain_futures(n, use_as_completed):
+    @gen.coroutine
+    def f():
+        fs = [Future() for _ in range(n)]
+        order = list(fs)
+        random.shuffle(order)
+        for future in order:
+            IOLoop.current().add_callback(future.set_result, None)
+
+        if use_as_completed:
+            for next_future in futures.as_completed(fs):
+                yield next_future
+        else:
+            pending = set(fs)
+            while pending:
+                future, result = yield futures.wait_any(pending)
+                pending.remove(future)
+
+    return f
+
+
+CASES = [
+    ('WaitAny', lambda n: drain_keys(n, yieldpoints.WaitAny)),
+    ('AsCompleted', lambda n: drain_keys(n, yieldpoints.AsCompleted)),
+    ('futures.wait_any', lambda n: drain_futures(n, False)),
+    ('futures.as_completed', lambda n: drain_futures(n, True)),
+]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [n ...]')
+    parser.add_option('--max-quadratic', type='int', default=5000,
+                      help="largest n for the O(n^2) wait_any loops")
+    options, args = parser.parse_args()
+    sizes = [int(arg) for arg in args] or [100, 1000, 10000]
+
+    for n in sizes:
+        for name, make in CASES:
+            if name in ('WaitAny', 'futures.wait_any') \
+                    and n > options.max_quadratic:
+                continue
+
+            io_loop = IOLoop()
+            io_loop.make_current()
+            start = time.time()
+            io_loop.run_sync(make(n), timeout=3600)
+            duration = time.time() - start
+            io_loop.clear_current()
+            io_loop.close()
+            print('n=%-7d %-22s %8.3fs  %10.0f keys/sec' % (
+                n, name, duration, n / duration))
+
+
+if __name__ == '__main__':
+    main()
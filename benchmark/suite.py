@@ -0,0 +1,457 @@
+"""Benchmark suite for the yield points.
+
+Each case reports operations per second, percentiles of the time each wait
+took, and peak memory allocated by Python while it ran (with
+``tracemalloc``, on Python 3.4 and later). Save the results as JSON and
+compare them with a run from another commit::
+
+    python benchmark/suite.py --json before.json
+    git checkout my-branch
+    python benchmark/suite.py --json after.json --compare before.json
+
+Cases:
+
+  - ``wait_any``: drain n keys with :class:`~yieldpoints.WaitAny` and with
+    :class:`~yieldpoints.AsCompleted`
+  - ``with_timeout``: churn through waits that mostly finish before their
+    :class:`~yieldpoints.WithTimeout` deadlines
+  - ``cancel``: :class:`~yieldpoints.Cancel` and
+    :class:`~yieldpoints.CancelAll` on large pending sets
+  - ``page_race``: the ``examples/example.py`` pattern, against a local HTTP
+    server with a configurable latency distribution
+  - ``reuse``: a loop that allocates a :class:`~yieldpoints.WithTimeout`
+    and :class:`~yieldpoints.WaitAny` per wait, or re-yields one pair. With
+    ``tracemalloc``, also reports blocks and bytes allocated per wait
+"""
+
+from datetime import timedelta
+from optparse import OptionParser
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import tornado
+from tornado import gen, httpclient, web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+# Import yieldpoints from this checkout, wherever the script is run from.
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yieldpoints
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        index = int(math.ceil(p / 100.0 * len(latencies))) - 1
+        return latencies[max(0, index)]
+
+    return {
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': latencies[-1]}
+
+
+class Timer(object):
+    """Collect per-wait latencies, and other results in ``extra``."""
+    def __init__(self):
+        self.latencies = []
+        self.start = None
+        self.extra = {}
+
+    def begin(self):
+        self.start = time.time()
+
+    def end(self):
+        self.latencies.append(time.time() - self.start)
+
+
+def measure(case, params, make_coroutine):
+    """Run a coroutine on a fresh IOLoop and summarize it.
+
+    ``make_coroutine(timer)`` returns a coroutine function, which returns the
+    number of operations it performed.
+    """
+    io_loop = IOLoop()
+    io_loop.make_current()
+    timer = Timer()
+    func = make_coroutine(timer)
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    start = time.time()
+    n_ops = io_loop.run_sync(func, timeout=3600)
+    duration = time.time() - start
+
+    peak_memory = None
+    if tracemalloc is not None:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    io_loop.clear_current()
+    io_loop.close(all_fds=True)
+    result = {
+        'case': case,
+        'params': params,
+        'ops': n_ops,
+        'duration': duration,
+        'ops_per_sec': n_ops / duration,
+        'latency': percentiles(timer.latencies),
+        'peak_memory': peak_memory}
+    result.update(timer.extra)
+    return result
+
+
+def wait_any(n, wait_class, policy=None):
+    def make(timer):
+        @gen.coroutine
+        def f():
+            callbacks = []
+            for key in range(n):
+                callbacks.append((yield gen.Callback(key)))
+
+            order = list(range(n))
+            random.shuffle(order)
+            for key in order:
+                IOLoop.current().add_callback(callbacks[key])
+
+            if wait_class is yieldpoints.AsCompleted:
+                completed = yieldpoints.AsCompleted(range(n))
+                while completed:
+                    timer.begin()
+                    yield completed
+                    timer.end()
+            else:
+                pending = set(range(n))
+                kwargs = {}
+                if policy is not None:
+                    kwargs['policy'] = policy()
+
+                while pending:
+                    timer.begin()
+                    key, result = yield wait_class(pending, **kwargs)
+                    timer.end()
+                    pending.remove(key)
+
+            raise gen.Return(n)
+
+        return f
+
+    return make
+
+
+def with_timeout(n, expire_ratio, timer_wheel):
+    def make(timer):
+        @gen.coroutine
+        def f():
+            io_loop = IOLoop.current()
+            if timer_wheel:
+                wheel = yieldpoints.TimerWheel(io_loop=io_loop)
+            else:
+                wheel = None
+
+            for i in range(n):
+                callback = yield gen.Callback(i)
+                if random.random() < expire_ratio:
+                    io_loop.add_timeout(timedelta(seconds=0.002), callback)
+                else:
+                    io_loop.add_callback(callback)
+
+                timer.begin()
+                try:
+                    yield yieldpoints.WithTimeout(
+                        timedelta(seconds=0.001), i, io_loop, wheel)
+                except yieldpoints.TimeoutException:
+                    yield yieldpoints.Cancel(i)
+                timer.end()
+
+            raise gen.Return(n)
+
+        return f
+
+    return make
+
+
+def cancel(n, cancel_all):
+    def make(timer):
+        @gen.coroutine
+        def f():
+            for key in range(n):
+                yield gen.Callback(key)
+
+            if cancel_all:
+                timer.begin()
+                yield yieldpoints.CancelAll()
+                timer.end()
+            else:
+                for key in range(n):
+                    timer.begin()
+                    yield yieldpoints.Cancel(key)
+                    timer.end()
+
+            raise gen.Return(n)
+
+        return f
+
+    return make
+
+
+def reuse(n, reuse_instances, sample=1000):
+    def make(timer):
+        @gen.coroutine
+        def f():
+            io_loop = IOLoop.current()
+            keys = [None]
+            wait = yieldpoints.WithTimeout(
+                timedelta(seconds=1), yieldpoints.WaitAny(keys), io_loop)
+
+            # Keep the first sample's yield points alive, so a tracemalloc
+            # snapshot counts what each wait allocated.
+            retained = []
+            snapshot = None
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+
+            for i in range(n):
+                keys[0] = i
+                io_loop.add_callback((yield gen.Callback(i)))
+                if not reuse_instances:
+                    wait = yieldpoints.WithTimeout(
+                        timedelta(seconds=1), yieldpoints.WaitAny(keys),
+                        io_loop)
+
+                timer.begin()
+                yield wait
+                timer.end()
+                if i < sample:
+                    retained.append(wait)
+                elif i == sample and snapshot is not None:
+                    stats = tracemalloc.take_snapshot().compare_to(
+                        snapshot, 'filename')
+                    timer.extra['blocks_per_op'] = sum(
+                        stat.count_diff for stat in stats) / float(sample)
+                    timer.extra['bytes_per_op'] = sum(
+                        stat.size_diff for stat in stats) / float(sample)
+                    del retained[:]
+
+            raise gen.Return(n)
+
+        return f
+
+    return make
+
+
+LATENCIES = {
+    'constant': lambda mean: mean,
+    'uniform': lambda mean: random.uniform(0, 2 * mean),
+    'exponential': lambda mean: random.expovariate(1.0 / mean),
+    'lognormal': lambda mean: random.lognormvariate(
+        math.log(mean) - 0.5, 1.0),
+}
+
+
+class SlowHandler(web.RequestHandler):
+    @web.asynchronous
+    def get(self):
+        delay = self.application.settings['latency']()
+        IOLoop.current().add_timeout(
+            timedelta(seconds=delay), lambda: self.finish('x'))
+
+
+def page_race(n_urls, n_races, distribution, mean, deadline):
+    latency = LATENCIES[distribution]
+
+    def make(timer):
+        @gen.coroutine
+        def f():
+            sockets = bind_sockets(0, '127.0.0.1')
+            port = sockets[0].getsockname()[1]
+            app = web.Application([('.*', SlowHandler)],
+                                  latency=lambda: latency(mean))
+            server = HTTPServer(app)
+            server.add_sockets(sockets)
+            client = httpclient.AsyncHTTPClient(
+                force_instance=True, max_clients=n_urls)
+
+            n_ops = 0
+            for race in range(n_races):
+                urls = set('http://127.0.0.1:%d/%d/%d' % (port, race, i)
+                           for i in range(n_urls))
+                for url in urls:
+                    client.fetch(url, callback=(yield gen.Callback(url)))
+
+                start = time.time()
+                pending_urls = urls.copy()
+                while pending_urls:
+                    timer.begin()
+                    try:
+                        url, response = yield yieldpoints.WithTimeout(
+                            start + deadline,
+                            yieldpoints.WaitAny(pending_urls))
+                    except yieldpoints.TimeoutException:
+                        timer.end()
+                        yield yieldpoints.CancelAll()
+                        break
+
+                    timer.end()
+                    n_ops += 1
+                    pending_urls.remove(url)
+
+            client.close()
+            server.stop()
+            raise gen.Return(n_ops)
+
+        return f
+
+    return make
+
+
+def cases(options):
+    for n in options.sizes:
+        for wait_class in (yieldpoints.WaitAny, yieldpoints.AsCompleted):
+            if wait_class is yieldpoints.WaitAny and n > options.max_quadratic:
+                continue
+
+            yield ('wait_any', {'n': n, 'class': wait_class.__name__},
+                   wait_any(n, wait_class))
+
+        for policy in (yieldpoints.FIFOPolicy, yieldpoints.RoundRobinPolicy):
+            yield ('wait_any',
+                   {'n': n, 'class': 'WaitAny', 'policy': policy.__name__},
+                   wait_any(n, yieldpoints.WaitAny, policy))
+
+    for timer_wheel in (False, True):
+        yield ('with_timeout',
+               {'n': options.churn, 'expire_ratio': 0.1,
+                'timer_wheel': timer_wheel},
+               with_timeout(options.churn, 0.1, timer_wheel))
+
+    for n in options.sizes:
+        for cancel_all in (False, True):
+            yield ('cancel', {'n': n, 'cancel_all': cancel_all},
+                   cancel(n, cancel_all))
+
+    for reuse_instances in (False, True):
+        yield ('reuse', {'n': options.churn, 'reuse': reuse_instances},
+               reuse(options.churn, reuse_instances))
+
+    for distribution in options.distributions:
+        yield ('page_race',
+               {'urls': options.urls, 'races': options.races,
+                'distribution': distribution, 'mean': options.mean,
+                'deadline': options.deadline},
+               page_race(options.urls, options.races, distribution,
+                         options.mean, options.deadline))
+
+
+def git_revision():
+    # Don't print git's error if this isn't a checkout.
+    devnull = open(os.devnull, 'w')
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=devnull).decode().strip()
+    except Exception:
+        return None
+    finally:
+        devnull.close()
+
+
+def key(result):
+    return result['case'], json.dumps(result['params'], sort_keys=True)
+
+
+def report(result, baseline=None):
+    latency = result['latency']
+    line = '%-12s %-60s %12.0f ops/s  p50=%.6f p99=%.6f' % (
+        result['case'], json.dumps(result['params'], sort_keys=True),
+        result['ops_per_sec'], latency.get('p50', 0), latency.get('p99', 0))
+
+    if result['peak_memory'] is not None:
+        line += '  peak=%.1fMB' % (result['peak_memory'] / 1e6)
+
+    if 'blocks_per_op' in result:
+        line += '  %.1f blocks/op %.0f bytes/op' % (
+            result['blocks_per_op'], result['bytes_per_op'])
+
+    if baseline is not None:
+        line += '  (%+.1f%% ops/s)' % (
+            100.0 * (result['ops_per_sec'] / baseline['ops_per_sec'] - 1))
+
+    print(line)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--case', action='append', dest='cases',
+                      help='run only this case; may be repeated')
+    parser.add_option('--sizes', default='10,100,1000,10000,100000',
+                      help='key counts for wait_any and cancel')
+    parser.add_option('--max-quadratic', type='int', default=10000,
+                      help='largest n for the O(n^2) WaitAny loop')
+    parser.add_option('--churn', type='int', default=10000,
+                      help='waits for the with_timeout case')
+    parser.add_option('--urls', type='int', default=50,
+                      help='URLs per page race')
+    parser.add_option('--races', type='int', default=10,
+                      help='number of page races')
+    parser.add_option('--distributions',
+                      default='constant,exponential,lognormal',
+                      help='server latency distributions: %s' % ', '.join(
+                          sorted(LATENCIES)))
+    parser.add_option('--mean', type='float', default=0.01,
+                      help='mean server latency in seconds')
+    parser.add_option('--deadline', type='float', default=0.5,
+                      help='seconds before a page race gives up')
+    parser.add_option('--json', help='save results to this file')
+    parser.add_option('--compare', help='compare with results in this file')
+    options, args = parser.parse_args()
+    options.sizes = [int(n) for n in options.sizes.split(',')]
+    options.distributions = options.distributions.split(',')
+
+    baselines = {}
+    if options.compare:
+        with open(options.compare) as f:
+            for result in json.load(f)['results']:
+                baselines[key(result)] = result
+
+    results = []
+    for case, params, make_coroutine in cases(options):
+        if options.cases and case not in options.cases:
+            continue
+
+        result = measure(case, params, make_coroutine)
+        results.append(result)
+        report(result, baselines.get(key(result)))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'tornado': tornado.version,
+                'yieldpoints': yieldpoints.version,
+                'time': time.time(),
+                'argv': sys.argv[1:],
+                'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Compare per-wait ``IOLoop`` timeouts with a shared
+:class:`~yieldpoints.TimerWheel`.
+
+Start many coroutines that each wait on a key with
+:class:`~yieldpoints.WithTimeout`. Most keys complete before the deadline;
+the rest time out. Report the size of the ``IOLoop``'s timeout heap while
+all waits are pending, and how many times a timer woke the loop.
+
+    python benchmark/timer_wheel.py -n 100000
+"""
+
+from datetime import timedelta
+from optparse import OptionParser
+import os
+import sys
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+# Import yieldpoints from this checkout, wherever the script is run from.
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yieldpoints
+
+
+def run(n, timeout, expire_ratio, slack):
+    io_loop = IOLoop()
+    io_loop.make_current()
+    if slack:
+        timer_wheel = yieldpoints.TimerWheel(slack, io_loop)
+    else:
+        timer_wheel = None
+
+    stats = {'expired': 0, 'heap_peak': 0, 'running': n}
+    n_expire = int(n * expire_ratio)
+    done = []
+
+    @gen.coroutine
+    def wait(i):
+        callback = yield gen.Callback(i)
+        if i >= n_expire:
+            io_loop.add_callback(callback)
+
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=timeout), i, io_loop, timer_wheel)
+        except yieldpoints.TimeoutException:
+            stats['expired'] += 1
+            yield yieldpoints.Cancel(i)
+
+        stats['running'] -= 1
+        if not stats['running']:
+            done[0]()
+
+    @gen.coroutine
+    def main():
+        # Don't yield a list of n futures, gen.Multi is O(n^2).
+        done.append((yield gen.Callback('done')))
+        for i in range(n):
+            wait(i)
+
+        stats['heap_peak'] = len(io_loop._timeouts)
+        yield gen.Wait('done')
+
+    start = time.time()
+    io_loop.run_sync(main, timeout=timeout + 60)
+    duration = time.time() - start
+
+    if timer_wheel is not None:
+        wakeups = timer_wheel.wakeups
+    else:
+        wakeups = stats['expired']
+
+    io_loop.clear_current()
+    io_loop.close()
+    return {
+        'duration': duration,
+        'expired': stats['expired'],
+        'heap_peak': stats['heap_peak'],
+        'timer_wakeups': wakeups}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', type='int', default=100000,
+                      help='concurrent timeouts (default 100000)')
+    parser.add_option('--timeout', type='float', default=30,
+                      help='seconds before each wait times out (default 30)')
+    parser.add_option('--expire-ratio', type='float', default=0.1,
+                      help='fraction of waits that time out (default 0.1)')
+    parser.add_option('--slack', type='float', default=0.01,
+                      help='TimerWheel slack in seconds (default 0.01)')
+    options, args = parser.parse_args()
+
+    for name, slack in [('IOLoop', None), ('TimerWheel', options.slack)]:
+        result = run(options.n, options.timeout, options.expire_ratio, slack)
+        print('%-10s  %7.2fs  expired=%-7d heap_peak=%-7d timer_wakeups=%d' % (
+            name, result['duration'], result['expired'], result['heap_peak'],
+            result['timer_wakeups']))
+
+
+if __name__ == '__main__':
+    main()
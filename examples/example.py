@@ -1,6 +1,7 @@
 """An example for :class:`~yieldpoints.WaitAny`, :class:`~yieldpoints.WithTimeout`,
-and :class:`~yieldpoints.CancelAll`: download several web pages at once and
-take action as each completes. After 0.5 seconds, stop waiting.
+:class:`~yieldpoints.CancelAll`, and :class:`~yieldpoints.CoalescingWriter`:
+download several web pages at once and take action as each completes. After
+0.5 seconds, stop waiting.
 """
 
 # start-file
@@ -21,7 +22,9 @@ class PageRaceHandler(web.RequestHandler):
             'http://google.com', 'http://apple.com', 'http://microsoft.com',
             'http://amazon.com'])
 
-        self.write('<table border="1">')
+        # Send rows in batches, rather than flushing after each one
+        writer = yieldpoints.CoalescingWriter(self)
+        writer.write('<table border="1">')
 
         start = time.time()
         def duration():
@@ -43,7 +46,7 @@ class PageRaceHandler(web.RequestHandler):
                     start + 0.5, yieldpoints.WaitAny(pending_urls))
 
             except yieldpoints.TimeoutException:
-                self.finish("""
+                writer.finish("""
                     </table>
 
                     <p>These URLs did not complete after %.1f seconds: %s</p>
@@ -54,7 +57,7 @@ class PageRaceHandler(web.RequestHandler):
                 return
 
             pending_urls.remove(url)
-            self.write("""
+            yield writer.write("""
                 <tr>
                     <td>%s</td>
                     <td>HTTP %s</td>
@@ -62,9 +65,7 @@ class PageRaceHandler(web.RequestHandler):
                 </tr>
             """ % (url, response.code, duration()))
 
-            yield gen.Task(self.flush)
-
-        self.finish("""
+        writer.finish("""
             </table>
 
             <p>Completed all in %.1f seconds</p>
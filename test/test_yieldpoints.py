@@ -6,12 +6,28 @@ from __future__ import with_statement
 
 from datetime import timedelta
 from functools import partial
+import os
+import sys
+import tempfile
 import time
+import unittest
 
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.testing import AsyncTestCase, gen_test
 
 import yieldpoints
+from yieldpoints import debug, futures, metrics, tracing
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 
 class TestWaitAny(AsyncTestCase):
@@ -55,6 +71,384 @@ class TestWaitAny(AsyncTestCase):
         self.assertEqual(('key', 'result'), wait_any.get_result())
 
 
+class TestPolicies(AsyncTestCase):
+    @gen.coroutine
+    def drain(self, completion_order, policy):
+        keys = list(range(5))
+        callbacks = []
+        for key in keys:
+            callbacks.append((yield yieldpoints.Callback(key)))
+
+        for key in completion_order:
+            callbacks[key](key)
+
+        order = []
+        while keys:
+            key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+            self.assertEqual(key, result)
+            order.append(key)
+            keys.remove(key)
+
+        raise gen.Return(order)
+
+    @gen_test
+    def test_default(self):
+        order = yield self.drain([3, 1, 4, 0, 2], None)
+        self.assertEqual([0, 1, 2, 3, 4], order)
+
+    @gen_test
+    def test_fifo(self):
+        order = yield self.drain([3, 1, 4, 0, 2], yieldpoints.FIFOPolicy())
+        self.assertEqual([3, 1, 4, 0, 2], order)
+
+    @gen_test
+    def test_fifo_waiting(self):
+        callbacks = []
+        for key in range(3):
+            callbacks.append((yield gen.Callback(key)))
+
+        self.io_loop.add_timeout(timedelta(seconds=0.01), callbacks[2])
+        policy = yieldpoints.FIFOPolicy()
+        wait = yieldpoints.WaitAny([0, 1, 2], policy=policy)
+        key, result = yield wait
+        self.assertEqual(2, key)
+
+        # The other keys are watched by the policy's queue, not the WaitAny
+        watchers = wait.runner.results.watchers
+        self.assertFalse(wait in watchers.values())
+        self.assertTrue(watchers[0] is policy.ready_keys)
+        yield yieldpoints.CancelAll()
+
+    @gen_test
+    def test_queue_kept(self):
+        callbacks = []
+        for key in range(4):
+            callbacks.append((yield gen.Callback(key)))
+
+        policy = yieldpoints.FIFOPolicy()
+        keys = [0, 1, 2, 3]
+        callbacks[2](2)
+        key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+        keys.remove(key)
+        ready = policy.ready_keys
+
+        # The queue is kept for the next wait
+        callbacks[0](0)
+        key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+        self.assertEqual(0, key)
+        keys.remove(key)
+        self.assertTrue(policy.ready_keys is ready)
+
+        # Removing a key that wasn't returned makes a new queue
+        keys.remove(3)
+        callbacks[3](3)
+        callbacks[1](1)
+        key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+        self.assertEqual(1, key)
+        self.assertFalse(policy.ready_keys is ready)
+        yield gen.Wait(3)
+
+    @gen_test
+    def test_priority(self):
+        policy = yieldpoints.PriorityPolicy({4: -2, 1: -1})
+        order = yield self.drain([0, 1, 2, 3, 4], policy)
+        self.assertEqual([4, 1, 0, 2, 3], order)
+
+        policy = yieldpoints.PriorityPolicy(lambda key: -key)
+        order = yield self.drain([0, 1, 2, 3, 4], policy)
+        self.assertEqual([4, 3, 2, 1, 0], order)
+
+    @gen_test
+    def test_random(self):
+        order = yield self.drain([0, 1, 2, 3, 4], yieldpoints.RandomPolicy())
+        self.assertEqual([0, 1, 2, 3, 4], sorted(order))
+
+    @gen_test
+    def test_round_robin(self):
+        # Each key is ready again as soon as it's served. By default 'a' is
+        # served every time.
+        keys = ['a', 'b', 'c']
+        for key in keys:
+            (yield gen.Callback(key))(key)
+
+        policy = yieldpoints.RoundRobinPolicy()
+        served = []
+        for _ in range(7):
+            key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+            served.append(key)
+            (yield gen.Callback(key))(key)
+
+        self.assertEqual(list('abcabca'), served)
+        yield yieldpoints.WaitSome(keys)
+
+    @gen_test
+    def test_round_robin_removed(self):
+        order = yield self.drain(
+            [0, 1, 2, 3, 4], yieldpoints.RoundRobinPolicy())
+        self.assertEqual([0, 1, 2, 3, 4], order)
+
+
+class TestGather(AsyncTestCase):
+    @gen_test
+    def test_all_complete(self):
+        callbacks = []
+        for key in range(3):
+            callbacks.append((yield gen.Callback(key)))
+
+        callbacks[0]('zero')
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callbacks[1], 'one'))
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.02), partial(callbacks[2], 'two'))
+
+        results, missing = yield yieldpoints.Gather(
+            range(3), timedelta(seconds=1), io_loop=self.io_loop)
+
+        self.assertEqual({0: 'zero', 1: 'one', 2: 'two'}, results)
+        self.assertEqual(set(), missing)
+
+    @gen_test
+    def test_deadline(self):
+        @gen.engine
+        def test(callback):
+            callbacks = []
+            for key in range(3):
+                callbacks.append((yield gen.Callback(key)))
+
+            loop = self.io_loop
+            loop.add_timeout(timedelta(seconds=0.01), callbacks[0])
+            loop.add_timeout(timedelta(seconds=0.01), callbacks[1])
+            loop.add_timeout(timedelta(seconds=0.1), callbacks[2])
+
+            start = time.time()
+            gather = yieldpoints.Gather(
+                range(3), timedelta(seconds=0.03), io_loop=self.io_loop)
+            results, missing = yield gather
+            callback((results, missing, time.time() - start))
+
+        try:
+            results, missing, duration = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual({0: None, 1: None}, results)
+        self.assertEqual(set([2]), missing)
+        self.assertTrue(duration < 0.05)
+
+        # The canceled key can still complete without error
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.1))
+
+    @gen_test
+    def test_no_cancel(self):
+        callback = yield gen.Callback('key')
+        results, missing = yield yieldpoints.Gather(
+            ['key'], timedelta(seconds=0.01), cancel=False,
+            io_loop=self.io_loop)
+
+        self.assertEqual({}, results)
+        self.assertEqual(set(['key']), missing)
+        callback('result')
+        self.assertEqual('result', (yield gen.Wait('key')))
+
+
+class TestWaitSome(AsyncTestCase):
+    @gen_test
+    def test_basic(self):
+        keys = list(range(4))
+        callbacks = []
+        for key in keys:
+            callbacks.append((yield gen.Callback(key)))
+
+        callbacks[2]('c')
+        callbacks[0]('a')
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callbacks[3], 'd'))
+
+        results = yield yieldpoints.WaitSome(keys)
+        self.assertEqual([(0, 'a'), (2, 'c')], results)
+
+        results = yield yieldpoints.WaitSome([1, 3])
+        self.assertEqual([(3, 'd')], results)
+        yield yieldpoints.Cancel(1)
+
+    @gen_test
+    def test_max_results(self):
+        keys = list(range(3))
+        for key in keys:
+            (yield gen.Callback(key))(key)
+
+        results = yield yieldpoints.WaitSome(keys, max_results=2)
+        self.assertEqual([(0, 0), (1, 1)], results)
+        results = yield yieldpoints.WaitSome([2], max_results=2)
+        self.assertEqual([(2, 2)], results)
+
+    @gen_test
+    def test_timeout(self):
+        yield gen.Callback('key')
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01),
+                yieldpoints.WaitSome(['key']),
+                self.io_loop)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        yield yieldpoints.Cancel('key')
+
+
+class TestWaitN(AsyncTestCase):
+    @gen_test
+    def test_basic(self):
+        keys = list(range(3))
+        callbacks = []
+        for key in keys:
+            callbacks.append((yield gen.Callback(key)))
+
+        loop = self.io_loop
+        loop.add_timeout(timedelta(seconds=0.01), partial(callbacks[2], 'c'))
+        loop.add_timeout(timedelta(seconds=0.02), partial(callbacks[0], 'a'))
+        loop.add_timeout(timedelta(seconds=0.03), partial(callbacks[1], 'b'))
+
+        results = yield yieldpoints.WaitN(2, keys)
+        self.assertEqual([(2, 'c'), (0, 'a')], results)
+        self.assertEqual((1, 'b'), (yield yieldpoints.WaitAny([1])))
+
+    @gen_test
+    def test_already_complete(self):
+        for key in range(3):
+            (yield gen.Callback(key))(key)
+
+        results = yield yieldpoints.WaitN(3, list(range(3)))
+        self.assertEqual([(0, 0), (1, 1), (2, 2)], sorted(results))
+
+    @gen_test
+    def test_already_complete_order(self):
+        # Replace runner.results first, so it sees the order results arrive
+        (yield gen.Callback('x'))()
+        yield yieldpoints.WaitAny(['x'])
+
+        callbacks = {}
+        for key in ['a', 'b', 'c']:
+            callbacks[key] = yield gen.Callback(key)
+
+        callbacks['c']('c')
+        callbacks['b']('b')
+        results = yield yieldpoints.WaitN(2, ['a', 'b', 'c'])
+        self.assertEqual([('c', 'c'), ('b', 'b')], results)
+        callbacks['a']('a')
+        yield yieldpoints.Cancel('a')
+
+    @gen_test
+    def test_cancel_rest(self):
+        @gen.engine
+        def test(callback):
+            keys = list(range(3))
+            callbacks = []
+            for key in keys:
+                callbacks.append((yield gen.Callback(key)))
+
+            callbacks[0]('a')
+            callbacks[1]('b') # complete, but not one of the first n
+            results = yield yieldpoints.WaitN(1, keys, cancel_rest=True)
+            callback(results)
+
+        try:
+            results = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual([(0, 'a')], results)
+
+    @gen_test
+    def test_timeout(self):
+        (yield gen.Callback(0))('a')
+        yield gen.Callback(1) # never called
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01),
+                yieldpoints.WaitN(2, [0, 1]),
+                self.io_loop)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        yield yieldpoints.CancelAll()
+
+    def test_too_many(self):
+        self.assertRaises(ValueError, yieldpoints.WaitN, 3, [0, 1])
+
+
+class TestAsCompleted(AsyncTestCase):
+    @gen_test
+    def test_basic(self):
+        keys = list(range(3))
+        callbacks = []
+        for key in keys:
+            callbacks.append((yield gen.Callback(key)))
+
+        loop = self.io_loop
+        loop.add_timeout(timedelta(seconds=0.01), partial(callbacks[1], 'b'))
+        loop.add_timeout(timedelta(seconds=0.02), partial(callbacks[0], 'a'))
+        loop.add_timeout(timedelta(seconds=0.03), partial(callbacks[2], 'c'))
+
+        completed = yieldpoints.AsCompleted(keys)
+        self.assertEqual(3, len(completed))
+        history = []
+        while completed:
+            history.append((yield completed))
+
+        self.assertEqual([(1, 'b'), (0, 'a'), (2, 'c')], history)
+
+    @gen_test
+    def test_already_complete(self):
+        callback0 = yield gen.Callback(0)
+        callback1 = yield gen.Callback(1)
+        callback0('a')
+        callback1('b')
+
+        completed = yieldpoints.AsCompleted([0, 1])
+        results = []
+        while completed:
+            results.append((yield completed))
+
+        self.assertEqual([(0, 'a'), (1, 'b')], sorted(results))
+
+    @gen_test
+    def test_cancel(self):
+        callback = yield gen.Callback(0)
+        yield gen.Callback(1) # never called
+        self.io_loop.add_timeout(timedelta(seconds=0.01), callback)
+
+        completed = yieldpoints.AsCompleted([0, 1])
+        key, result = yield completed
+        self.assertEqual(0, key)
+        yield yieldpoints.Cancel(1)
+        self.assertFalse(completed)
+
+    @gen_test
+    def test_timeout(self):
+        callback = yield gen.Callback('key')
+        completed = yieldpoints.AsCompleted(['key'])
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), completed, self.io_loop)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        # The same AsCompleted can be yielded again after a timeout
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callback, 'result'))
+        self.assertEqual(('key', 'result'), (yield completed))
+
+
 # Tests for the WithTimeout class
 class TestWithTimeout(AsyncTestCase):
     @gen_test
@@ -161,55 +555,1748 @@ class TestWithTimeout(AsyncTestCase):
             self.fail("No TimeoutException raised")
 
 
-class TestCancel(AsyncTestCase):
     @gen_test
-    def test_cancel(self):
-        @gen.engine
-        def test(callback):
-            yield gen.Callback('key') # never called
-            yield yieldpoints.Cancel('key')
-            callback()
+    def test_timeout_removed(self):
+        # A wait that completes first doesn't leave its timeout scheduled
+        (yield gen.Callback('key'))('result')
+        with_timeout = yieldpoints.WithTimeout(
+            timedelta(seconds=0.01), 'key', self.io_loop)
+
+        self.assertEqual('result', (yield with_timeout))
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        self.assertFalse(with_timeout.expired)
+
+
+class TestDeadline(AsyncTestCase):
+    @gen.coroutine
+    def wait(self, seconds, delay=None):
+        # Wait with a timeout of seconds for a key that's called after delay.
+        # Return the WithTimeout and how it ended.
+        callback = yield gen.Callback('key')
+        if delay is not None:
+            self.io_loop.add_timeout(
+                timedelta(seconds=delay), partial(callback, 'result'))
+
+        with_timeout = yieldpoints.WithTimeout(
+            None if seconds is None else timedelta(seconds=seconds),
+            'key', self.io_loop)
 
         try:
-            yield gen.Task(test)
-            pass
-        except gen.LeakedCallbackError:
-            self.fail("LeakedCallbackError was unexpectedly raised")
+            result = yield with_timeout
+        except yieldpoints.TimeoutException:
+            result = 'timeout'
+            yield yieldpoints.Cancel('key')
+
+        raise gen.Return((with_timeout, result))
 
     @gen_test
-    def test_cancel_unknown_key(self):
-        @gen.engine
-        def test(callback):
-            yield yieldpoints.Cancel('key')
-            callback()
+    def test_inherited(self):
+        deadline = yieldpoints.Deadline(
+            timedelta(seconds=0.05), self.io_loop)
+
+        start = time.time()
+        with_timeout, result = yield yieldpoints.run_with_deadline(
+            deadline, self.wait, 1)
+
+        self.assertTrue(abs(time.time() - start - 0.05) < 0.02)
+        self.assertEqual('timeout', result)
+        self.assertTrue(with_timeout.inherited is deadline)
+
+    @gen_test
+    def test_own_deadline_sooner(self):
+        deadline = yieldpoints.Deadline(timedelta(seconds=1), self.io_loop)
+
+        start = time.time()
+        with_timeout, result = yield yieldpoints.run_with_deadline(
+            deadline, self.wait, 0.05)
+
+        self.assertTrue(abs(time.time() - start - 0.05) < 0.02)
+        self.assertEqual('timeout', result)
+        self.assertTrue(with_timeout.inherited is None)
+        self.assertTrue(deadline.timeout is None)
+
+    @gen_test
+    def test_nested(self):
+        @gen.coroutine
+        def outer():
+            # The sooner outer deadline is kept
+            result = yield yieldpoints.run_with_deadline(
+                timedelta(seconds=1), self.wait, None)
+            raise gen.Return(result)
+
+        deadline = yieldpoints.Deadline(
+            timedelta(seconds=0.05), self.io_loop)
+
+        with_timeout, result = yield yieldpoints.run_with_deadline(
+            deadline, outer)
+
+        self.assertEqual('timeout', result)
+        self.assertTrue(with_timeout.inherited is deadline)
+
+    @gen_test
+    def test_complete_first(self):
+        deadline = yieldpoints.Deadline(timedelta(seconds=1), self.io_loop)
+        with_timeout, result = yield yieldpoints.run_with_deadline(
+            deadline, self.wait, None, 0.01)
+
+        self.assertEqual('result', result)
+        self.assertTrue(with_timeout.inherited is deadline)
+        self.assertTrue(deadline.timeout is None)
+        self.assertFalse(deadline.callbacks)
+
+    @gen_test
+    def test_expired(self):
+        deadline = yieldpoints.Deadline(
+            timedelta(seconds=0.01), self.io_loop)
+        deadline.add_callback(lambda: None)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        self.assertTrue(deadline.expired)
+
+        with_timeout, result = yield yieldpoints.run_with_deadline(
+            deadline, self.wait, 1)
+
+        self.assertEqual('timeout', result)
+
+
+class TestReuse(AsyncTestCase):
+    @gen_test
+    def test_reuse(self):
+        callbacks = []
+        for key in range(3):
+            callbacks.append((yield gen.Callback(key)))
+
+        for i, callback in enumerate(callbacks):
+            self.io_loop.add_timeout(
+                timedelta(seconds=0.01 * (i + 1)), partial(callback, i))
+
+        pending = list(range(3))
+        wait = yieldpoints.WithTimeout(
+            timedelta(seconds=0.05), yieldpoints.WaitAny(pending),
+            self.io_loop)
+
+        history = []
+        while pending:
+            key, result = yield wait
+            history.append(key)
+            pending.remove(key)
+
+        self.assertEqual([0, 1, 2], history)
+
+    @gen_test
+    def test_reuse_after_timeout(self):
+        callback = yield gen.Callback('key')
+        wait = yieldpoints.WithTimeout(
+            timedelta(seconds=0.01), 'key', self.io_loop)
 
         try:
-            yield gen.Task(test)
-        except gen.UnknownKeyError:
-            # Success
+            yield wait
+        except yieldpoints.TimeoutException:
             pass
         else:
-            self.fail("UnknownKeyError not raised")
+            self.fail("TimeoutException not raised")
+
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callback, 'result'))
+        wait.reset(self.io_loop.time() + 0.05)
+        self.assertEqual('result', (yield wait))
 
+
+class TestTimerWheel(AsyncTestCase):
     @gen_test
-    def test_callback_after_cancel(self):
-        # Check that a canceled callback can still be run without error
-        key_callback = yield gen.Callback('key')
-        yield yieldpoints.Cancel('key')
-        key_callback()
+    def test_coalesce(self):
+        wheel = yieldpoints.TimerWheel(slack=0.05, io_loop=self.io_loop)
+        fired = []
+        deadline = self.io_loop.time() + 0.05
+        for i in range(100):
+            wheel.add_timeout(deadline + i * 0.0001, partial(fired.append, i))
 
+        self.assertEqual(100, len(wheel))
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.15))
+        self.assertEqual(list(range(100)), sorted(fired))
+        self.assertEqual(0, len(wheel))
+        self.assertTrue(wheel.wakeups <= 2)
 
-class TestCancelAll(AsyncTestCase):
     @gen_test
-    def test_timeout(self):
-        @gen.engine
-        def test(callback):
-            for i in range(2):
-                yield gen.Callback(i) # never called
-            yield yieldpoints.CancelAll()
-            callback()
+    def test_remove_timeout(self):
+        wheel = yieldpoints.TimerWheel(slack=0.01, io_loop=self.io_loop)
+        fired = []
+        handle = wheel.add_timeout(
+            timedelta(seconds=0.01), partial(fired.append, 'removed'))
+        wheel.add_timeout(timedelta(seconds=0.02), partial(fired.append, 'ok'))
+        wheel.remove_timeout(handle)
+        self.assertEqual(1, len(wheel))
 
-        try:
-            yield gen.Task(test)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.05))
+        self.assertEqual(['ok'], fired)
+
+        # Removing a fired timeout is a no-op
+        wheel.remove_timeout(handle)
+        self.assertEqual(0, len(wheel))
+
+    @gen_test
+    def test_remove_while_firing(self):
+        wheel = yieldpoints.TimerWheel(slack=0.01, io_loop=self.io_loop)
+        fired = []
+        handles = []
+
+        def callback(i):
+            fired.append(i)
+            # Remove the other timeout in the same slot
+            wheel.remove_timeout(handles[1 - i])
+
+        deadline = self.io_loop.time() + 0.01
+        for i in range(2):
+            handles.append(wheel.add_timeout(deadline, partial(callback, i)))
+
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.03))
+        self.assertEqual(1, len(fired))
+        self.assertEqual(0, len(wheel))
+
+    def test_removed_ticks(self):
+        wheel = yieldpoints.TimerWheel(slack=0.01, io_loop=self.io_loop)
+        deadline = self.io_loop.time() + 30
+        wheel.add_timeout(deadline + 1000, lambda: None)
+
+        # The same tick again and again is queued once
+        for _ in range(1000):
+            wheel.remove_timeout(wheel.add_timeout(deadline, lambda: None))
+        self.assertEqual(2, len(wheel.ticks))
+
+        # Dead ticks are compacted
+        for i in range(1000):
+            wheel.remove_timeout(
+                wheel.add_timeout(deadline + i * 0.01, lambda: None))
+        self.assertEqual(1, len(wheel))
+        self.assertTrue(len(wheel.ticks) <= 18)
+
+    @gen_test
+    def test_with_timeout(self):
+        wheel = yieldpoints.TimerWheel(slack=0.01, io_loop=self.io_loop)
+        yield gen.Callback('key') # never called
+        start = time.time()
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.1), 'key', self.io_loop, wheel)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        duration = time.time() - start
+        self.assertTrue(abs(duration - 0.1) < 0.02)
+        yield yieldpoints.Cancel('key')
+
+        (yield gen.Callback('key'))('result') # called immediately
+        result = yield yieldpoints.WithTimeout(
+            timedelta(seconds=0.1), 'key', self.io_loop, wheel)
+
+        self.assertEqual('result', result)
+        self.assertEqual(0, len(wheel))
+
+
+class Operation(object):
+    """A fake asynchronous operation. Call n completes after outcomes[n][0]
+    seconds, with outcomes[n][1] as its result.
+    """
+    def __init__(self, io_loop, outcomes):
+        self.io_loop = io_loop
+        self.outcomes = outcomes
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, *args, **kwargs):
+        delay, result = self.outcomes[len(self.calls)]
+        self.calls.append(args)
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        self.io_loop.add_timeout(
+            timedelta(seconds=delay),
+            partial(self._done, kwargs['callback'], result))
+
+    def _done(self, callback, result):
+        self.running -= 1
+        callback(result)
+
+
+class TestHedge(AsyncTestCase):
+    @gen_test
+    def test_primary_fast(self):
+        operation = Operation(self.io_loop, [(0.01, 0), (0.01, 1)])
+        hedge = yieldpoints.Hedge(operation, 0.05, io_loop=self.io_loop)
+        self.assertEqual(0, (yield hedge))
+        self.assertEqual(0, hedge.winner)
+
+        # No backup is started after the primary completes
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.06))
+        self.assertEqual(1, len(operation.calls))
+
+    @gen_test
+    def test_backup_wins(self):
+        @gen.engine
+        def test(callback):
+            operation = Operation(
+                self.io_loop, [(0.2, 0), (0.01, 1), (0.02, 2)])
+            hedge = yieldpoints.Hedge(
+                operation, 0.01, backups=2, io_loop=self.io_loop)
+
+            result = yield hedge
+            callback((result, hedge.winner, len(operation.calls)))
+
+        start = time.time()
+        try:
+            result, winner, n_calls = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertEqual(1, result)
+        self.assertEqual(1, winner)
+        self.assertEqual(3, n_calls)
+
+        # The primary and other backup can still complete without error
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.2))
+
+    @gen_test
+    def test_latency_window(self):
+        latencies = yieldpoints.LatencyWindow(default=0.01)
+        operation = Operation(self.io_loop, [(0.1, 0), (0.02, 1)])
+        result = yield yieldpoints.Hedge(
+            operation, latencies, io_loop=self.io_loop)
+
+        self.assertEqual(1, result)
+        self.assertEqual(1, len(latencies))
+        self.assertTrue(0.02 <= latencies.value() < 0.04)
+
+
+class TestRetry(AsyncTestCase):
+    @gen_test
+    def test_success_after_errors(self):
+        operation = Operation(
+            self.io_loop, [(0, ValueError()), (0, ValueError()), (0, 'ok')])
+        retry = yieldpoints.Retry(
+            operation, backoff=0.001, io_loop=self.io_loop)
+
+        self.assertEqual('ok', (yield retry))
+        self.assertEqual(3, retry.attempt)
+
+    @gen_test
+    def test_attempts_exhausted(self):
+        error = ValueError()
+        operation = Operation(
+            self.io_loop, [(0, 'bad'), (0, 'bad'), (0, error)])
+        result = yield yieldpoints.Retry(
+            operation, backoff=0.001, io_loop=self.io_loop,
+            is_error=lambda result: result != 'ok')
+
+        self.assertTrue(result is error)
+        self.assertEqual(3, len(operation.calls))
+
+    @gen_test
+    def test_attempt_timeout(self):
+        @gen.engine
+        def test(callback):
+            # The first attempt hangs, its late result is discarded
+            operation = Operation(self.io_loop, [(0.1, 'late'), (0, 'ok')])
+            result = yield yieldpoints.Retry(
+                operation, timeout=0.01, backoff=0.001, io_loop=self.io_loop)
+            callback(result)
+
+        try:
+            result = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual('ok', result)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.1))
+
+    @gen_test
+    def test_all_attempts_time_out(self):
+        operation = Operation(self.io_loop, [(0.1, 'late')] * 2)
+        try:
+            yield yieldpoints.Retry(
+                operation, attempts=2, timeout=0.01, backoff=0.001,
+                io_loop=self.io_loop)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        self.assertEqual(2, len(operation.calls))
+
+    @gen_test
+    def test_deadline(self):
+        # The deadline passes during the second attempt
+        operation = Operation(self.io_loop, [(0.03, ValueError())] * 10)
+        start = time.time()
+        try:
+            yield yieldpoints.Retry(
+                operation, attempts=10, deadline=timedelta(seconds=0.05),
+                backoff=0.001, io_loop=self.io_loop)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        self.assertTrue(time.time() - start < 0.08)
+        self.assertEqual(2, len(operation.calls))
+
+    @gen_test
+    def test_backoff_past_deadline(self):
+        # Don't wait for a retry that would start after the deadline
+        error = ValueError()
+        operation = Operation(self.io_loop, [(0, error), (0, 'ok')])
+        start = time.time()
+        result = yield yieldpoints.Retry(
+            operation, deadline=timedelta(seconds=0.05), backoff=1e6,
+            max_backoff=1e6, io_loop=self.io_loop)
+
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertTrue(result is error)
+        self.assertEqual(1, len(operation.calls))
+
+
+    @gen_test
+    def test_abandoned_during_backoff(self):
+        # The caller times out while Retry waits to retry, and cancels it
+        operation = Operation(self.io_loop, [(0, ValueError())] * 10)
+        retry = yieldpoints.Retry(
+            operation, attempts=10, backoff=0.04, io_loop=self.io_loop)
+
+        @gen.engine
+        def test(callback):
+            try:
+                yield yieldpoints.WithTimeout(
+                    timedelta(seconds=0.05), retry, io_loop=self.io_loop,
+                    cancel=True)
+            except yieldpoints.TimeoutException:
+                pass
+            else:
+                self.fail("TimeoutException not raised")
+
+            callback(len(operation.calls))
+
+        try:
+            n_calls = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertTrue(retry.finished)
+        self.assertEqual(None, retry.attempt_timeout)
+
+        # func isn't called again
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.2))
+        self.assertEqual(n_calls, len(operation.calls))
+
+    @gen_test
+    def test_cancel_all_during_backoff(self):
+        operation = Operation(self.io_loop, [(0, ValueError()), (1, 'late')])
+        retry = yieldpoints.Retry(
+            operation, attempts=2, backoff=10, io_loop=self.io_loop)
+
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), retry, io_loop=self.io_loop)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        yield yieldpoints.CancelAll()
+        self.assertTrue(retry.finished)
+        self.assertEqual(None, retry.attempt_timeout)
+
+
+class TestSingleFlight(AsyncTestCase):
+    @gen_test
+    def test_coalesce(self):
+        operation = Operation(
+            self.io_loop, [(0.01, ('a', 1)), (0.01, ('b', 2))])
+        flight = yieldpoints.SingleFlight(operation, io_loop=self.io_loop)
+
+        @gen.coroutine
+        def get(name):
+            yield flight.call(name, 'key')
+            result = yield gen.Wait('key')
+            raise gen.Return(result)
+
+        results = yield [get('a'), get('a'), get('b')]
+        self.assertEqual([('a', 1), ('a', 1), ('b', 2)], results)
+        self.assertEqual([('a',), ('b',)], operation.calls)
+        self.assertEqual({}, flight.flights)
+
+    @gen_test
+    def test_waiter_cancels(self):
+        operation = Operation(self.io_loop, [(0.05, ('a', 1))])
+        flight = yieldpoints.SingleFlight(operation, io_loop=self.io_loop)
+
+        @gen.coroutine
+        def impatient():
+            yield flight.call('a', 'key')
+            try:
+                yield yieldpoints.WithTimeout(
+                    timedelta(seconds=0.01), 'key', self.io_loop, cancel=True)
+            except yieldpoints.TimeoutException:
+                raise gen.Return('timeout')
+
+        @gen.coroutine
+        def patient():
+            yield flight.call('a', 'key')
+            result = yield gen.Wait('key')
+            raise gen.Return(result)
+
+        results = yield [impatient(), patient()]
+        self.assertEqual(['timeout', ('a', 1)], results)
+        self.assertEqual([('a',)], operation.calls)
+
+    @gen_test
+    def test_raises(self):
+        calls = []
+
+        def operation(name, callback):
+            calls.append(name)
+            if len(calls) == 1:
+                raise IOError('down')
+            callback('ok')
+
+        flight = yieldpoints.SingleFlight(operation, io_loop=self.io_loop)
+        yield flight.call('a', 'key')
+        self.assertTrue(isinstance((yield gen.Wait('key')), IOError))
+        self.assertEqual({}, flight.flights)
+
+        yield flight.call('a', 'key')
+        self.assertEqual('ok', (yield gen.Wait('key')))
+        self.assertEqual(['a', 'a'], calls)
+
+    @gen_test
+    def test_abandoned(self):
+        calls = []
+        callbacks = []
+
+        def operation(name, callback):
+            calls.append(name)
+            callbacks.append(callback)
+
+        flight = yieldpoints.SingleFlight(
+            operation, ttl=10, io_loop=self.io_loop)
+        yield flight.call('a', 'key')
+        yield yieldpoints.Cancel('key')
+        self.assertEqual({}, flight.flights)
+
+        # The next caller doesn't join the hung call
+        yield flight.call('a', 'key')
+        self.assertEqual(['a', 'a'], calls)
+
+        # The abandoned call's late result isn't cached
+        callbacks[0]('stale')
+        callbacks[1]('fresh')
+        self.assertEqual('fresh', (yield gen.Wait('key')))
+        self.assertEqual('fresh', flight.cache.get('a')[1])
+
+    @gen_test
+    def test_ttl(self):
+        operation = Operation(self.io_loop, [(0, ('a', 1)), (0, ('a', 2))])
+        flight = yieldpoints.SingleFlight(
+            operation, ttl=0.05, io_loop=self.io_loop)
+
+        yield flight.call('a', 'key')
+        self.assertEqual(('a', 1), (yield gen.Wait('key')))
+        yield flight.call('a', 'key')
+        self.assertEqual(('a', 1), (yield gen.Wait('key')))
+        self.assertEqual(1, flight.hits)
+
+        # Expired
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.06))
+        yield flight.call('a', 'key')
+        self.assertEqual(('a', 2), (yield gen.Wait('key')))
+        self.assertEqual(2, len(operation.calls))
+
+    @gen_test
+    def test_lru(self):
+        operation = Operation(self.io_loop, [(0, 'result')] * 4)
+        flight = yieldpoints.SingleFlight(
+            operation, ttl=10, max_size=2, io_loop=self.io_loop)
+
+        for name in ['a', 'b', 'a', 'c', 'a', 'b']:
+            yield flight.call(name, 'key')
+            yield gen.Wait('key')
+
+        # 'b' was evicted when 'c' was added
+        self.assertEqual(
+            [('a',), ('b',), ('c',), ('b',)], operation.calls)
+        self.assertEqual(2, len(flight.cache))
+
+    def test_lru_cache_compacts(self):
+        cache = yieldpoints._LRUCache(3)
+        for i in range(1000):
+            cache[i % 5] = i
+            cache.get((i - 1) % 5)
+
+        self.assertEqual(3, len(cache))
+        self.assertTrue(len(cache.order) <= 2 * 3 + 16)
+        self.assertEqual(999, cache.get(4))
+
+
+class TestAdaptiveTimeout(AsyncTestCase):
+    def test_timeout(self):
+        adaptive = yieldpoints.AdaptiveTimeout(
+            percentile=50, factor=2, min_timeout=0.5, max_timeout=10,
+            initial=3, size=3)
+        self.assertEqual(3, adaptive.timeout())
+
+        adaptive.add(1)
+        self.assertEqual(2, adaptive.timeout())
+        adaptive.add(0.1)
+        adaptive.add(0.1)
+        self.assertEqual(0.5, adaptive.timeout())
+
+        for _ in range(3):
+            adaptive.add(100)
+        self.assertEqual(10, adaptive.timeout())
+        self.assertEqual(3, len(adaptive))
+
+    def test_label(self):
+        adaptive = yieldpoints.AdaptiveTimeout(factor=1, initial=3)
+        adaptive.label('a').add(1)
+        self.assertEqual(1, adaptive.label('a').timeout())
+        self.assertEqual(3, adaptive.label('b').timeout())
+        self.assertEqual(3, adaptive.timeout())
+
+    @gen_test
+    def test_with_timeout(self):
+        adaptive = yieldpoints.AdaptiveTimeout(factor=1, initial=0.05)
+        callback = yield gen.Callback('key')
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callback, 'result'))
+
+        result = yield yieldpoints.WithTimeout(
+            adaptive, 'key', io_loop=self.io_loop)
+        self.assertEqual('result', result)
+        self.assertEqual(1, len(adaptive))
+        self.assertTrue(0.005 < adaptive.timeout() < 0.05)
+
+    @gen_test
+    def test_timeout_grows(self):
+        adaptive = yieldpoints.AdaptiveTimeout(
+            percentile=50, factor=2, initial=0.01)
+        yield gen.Callback('key')
+        try:
+            yield yieldpoints.WithTimeout(
+                adaptive, 'key', io_loop=self.io_loop, cancel=True)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        # The timed-out wait counts as taking its whole timeout
+        self.assertTrue(0.02 <= adaptive.timeout() < 0.04)
+
+
+class TestCircuitBreaker(AsyncTestCase):
+    @gen_test
+    def test_trip(self):
+        breaker = yieldpoints.CircuitBreaker(
+            threshold=0.5, size=4, min_calls=4, reset_timeout=10,
+            io_loop=self.io_loop)
+
+        ok = Operation(self.io_loop, [(0, 'ok')] * 10)
+        error = Operation(self.io_loop, [(0, ValueError())] * 10)
+        for operation in [ok, error, ok]:
+            yield breaker.call(operation)
+            self.assertEqual('closed', breaker.state)
+
+        yield breaker.call(error)
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(1, breaker.trips)
+
+        # Fails fast, without calling the operation
+        try:
+            yield breaker.call(ok)
+        except yieldpoints.CircuitOpenError:
+            pass
+        else:
+            self.fail("CircuitOpenError not raised")
+
+        self.assertEqual(2, len(ok.calls))
+
+    @gen_test
+    def test_raises(self):
+        breaker = yieldpoints.CircuitBreaker(
+            threshold=1, size=2, min_calls=2, reset_timeout=0.01,
+            io_loop=self.io_loop)
+
+        def raises(callback):
+            raise IOError('down')
+
+        for _ in range(2):
+            try:
+                yield breaker.call(raises, timeout=1)
+            except IOError:
+                pass
+            else:
+                self.fail("IOError not raised")
+
+        self.assertEqual('open', breaker.state)
+
+        # A probe that raises opens the circuit again, and is released
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        try:
+            yield breaker.call(raises)
+        except IOError:
+            pass
+        else:
+            self.fail("IOError not raised")
+
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(0, breaker.probes_in_flight)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        ok = Operation(self.io_loop, [(0, 'ok')])
+        self.assertEqual('ok', (yield breaker.call(ok)))
+        self.assertEqual('closed', breaker.state)
+
+    @gen_test
+    def test_timeouts(self):
+        breaker = yieldpoints.CircuitBreaker(
+            threshold=1, size=2, min_calls=2, io_loop=self.io_loop)
+
+        @gen.engine
+        def test(callback):
+            slow = Operation(self.io_loop, [(0.1, 'late')] * 2)
+            for _ in range(2):
+                try:
+                    yield breaker.call(slow, timeout=0.01)
+                except yieldpoints.TimeoutException:
+                    pass
+                else:
+                    self.fail("TimeoutException not raised")
+            callback()
+
+        try:
+            yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual('open', breaker.state)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.1))
+
+    @gen_test
+    def test_half_open(self):
+        breaker = yieldpoints.CircuitBreaker(
+            threshold=1, size=1, min_calls=1, reset_timeout=0.01,
+            io_loop=self.io_loop)
+
+        error = Operation(self.io_loop, [(0, ValueError())] * 2)
+        yield breaker.call(error)
+        self.assertEqual('open', breaker.state)
+
+        # A failed probe opens the circuit again
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        yield breaker.call(error)
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(2, breaker.trips)
+
+        # While a probe is running, other calls fail fast
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        slow = Operation(self.io_loop, [(0.01, 'ok')])
+        probe = breaker.call(slow)
+        rejected = breaker.call(slow)
+
+        @gen.coroutine
+        def wait(yield_point):
+            try:
+                result = yield yield_point
+            except yieldpoints.CircuitOpenError:
+                result = 'rejected'
+            raise gen.Return(result)
+
+        results = yield [wait(probe), wait(rejected)]
+        self.assertEqual(['ok', 'rejected'], results)
+        self.assertEqual(1, len(slow.calls))
+        self.assertEqual('closed', breaker.state)
+
+
+class TestQueues(AsyncTestCase):
+    @gen_test
+    def test_get_put(self):
+        q = yieldpoints.Queue()
+        q.put_nowait(1)
+        self.assertEqual(1, (yield yieldpoints.Get(q)))
+        self.assertRaises(yieldpoints.QueueEmpty, q.get_nowait)
+
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(q.put_nowait, 2))
+        self.assertEqual(2, (yield yieldpoints.Get(q)))
+
+    @gen_test
+    def test_maxsize(self):
+        q = yieldpoints.Queue(maxsize=1)
+        yield yieldpoints.Put(q, 1)
+        self.assertTrue(q.full())
+        self.assertRaises(yieldpoints.QueueFull, q.put_nowait, 2)
+
+        self.io_loop.add_timeout(timedelta(seconds=0.01), q.get_nowait)
+        yield yieldpoints.Put(q, 2)
+        self.assertEqual([2], list(q.items))
+
+    @gen_test
+    def test_getters_fifo(self):
+        q = yieldpoints.Queue()
+
+        @gen.coroutine
+        def get():
+            item = yield yieldpoints.Get(q)
+            raise gen.Return(item)
+
+        futures = [get(), get()]
+        q.put_nowait('a')
+        q.put_nowait('b')
+        self.assertEqual(['a', 'b'], (yield futures))
+
+    @gen_test
+    def test_select(self):
+        q0, q1 = yieldpoints.Queue(), yieldpoints.Queue()
+        get0, get1 = yieldpoints.Get(q0), yieldpoints.Get(q1)
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(q1.put_nowait, 'x'))
+
+        case, item = yield yieldpoints.Select([get0, get1])
+        self.assertTrue(case is get1)
+        self.assertEqual('x', item)
+
+        # The losing case was withdrawn, so the next item stays queued
+        q0.put_nowait('y')
+        self.assertEqual(1, q0.qsize())
+
+    @gen_test
+    def test_select_immediate(self):
+        q0, q1 = yieldpoints.Queue(), yieldpoints.Queue(maxsize=1)
+        q1.put_nowait('full')
+        q0.put_nowait('x')
+        put = yieldpoints.Put(q1, 'y')
+        get = yieldpoints.Get(q0)
+
+        # The Put can't complete, the Get can
+        case, item = yield yieldpoints.Select([put, get])
+        self.assertTrue(case is get)
+        self.assertEqual(['full'], list(q1.items))
+
+        q1.get_nowait()
+        case, item = yield yieldpoints.Select([get, put])
+        self.assertTrue(case is put)
+        self.assertEqual(['y'], list(q1.items))
+
+    @gen_test
+    def test_select_put(self):
+        q = yieldpoints.Queue(maxsize=1)
+        q.put_nowait(1)
+        self.io_loop.add_timeout(timedelta(seconds=0.01), q.get_nowait)
+        case, result = yield yieldpoints.Select(
+            [yieldpoints.Put(q, 2), yieldpoints.Get(yieldpoints.Queue())])
+
+        self.assertTrue(result is None)
+        self.assertEqual([2], list(q.items))
+
+    @gen_test
+    def test_select_deadline(self):
+        q = yieldpoints.Queue()
+        start = time.time()
+        try:
+            yield yieldpoints.Select(
+                [yieldpoints.Get(q)], deadline=timedelta(seconds=0.01),
+                io_loop=self.io_loop)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        self.assertTrue(time.time() - start < 0.05)
+        q.put_nowait(1)
+        self.assertEqual(1, q.qsize())
+
+    @gen_test
+    def test_withdrawn_purged(self):
+        q = yieldpoints.Queue()
+        for _ in range(100):
+            try:
+                yield yieldpoints.Select(
+                    [yieldpoints.Get(q)], deadline=timedelta(0),
+                    io_loop=self.io_loop)
+            except yieldpoints.TimeoutException:
+                pass
+
+        self.assertTrue(len(q.getters) <= 17)
+
+
+class TestLatencyWindow(unittest.TestCase):
+    def test_percentile(self):
+        latencies = yieldpoints.LatencyWindow(percentile=95, default=1)
+        self.assertEqual(1, latencies.value())
+        for i in range(100, 0, -1):
+            latencies.add(i)
+
+        self.assertEqual(95, latencies.value())
+        self.assertEqual(50, latencies.value(50))
+        self.assertEqual(100, latencies.value(100))
+
+    def test_size(self):
+        latencies = yieldpoints.LatencyWindow(percentile=100, size=10)
+        for i in range(20, 0, -1):
+            latencies.add(i)
+
+        self.assertEqual(10, len(latencies))
+        self.assertEqual(10, latencies.value())
+
+
+class TestPool(AsyncTestCase):
+    @gen_test
+    def test_basic(self):
+        # Items are started in order, so call i is for item i
+        operation = Operation(self.io_loop, [
+            (0.03, 0), (0.01, 10), (0.01, 20), (0.01, 30), (0.01, 40)])
+
+        # A generator, to check items are consumed lazily
+        pool = yieldpoints.Pool(
+            operation, (i for i in range(5)), 2, io_loop=self.io_loop)
+
+        history = []
+        while pool:
+            history.append((yield pool))
+
+        self.assertEqual(2, operation.max_running)
+        self.assertEqual([(1, 10), (2, 20), (0, 0), (3, 30), (4, 40)],
+                         history)
+
+    @gen_test
+    def test_timeout(self):
+        operation = Operation(self.io_loop, [(0.01, 0), (1, 10), (0.01, 20)])
+        pool = yieldpoints.Pool(
+            operation, range(3), 2, timeout=timedelta(seconds=0.05),
+            io_loop=self.io_loop)
+
+        results, timed_out = [], []
+        while pool:
+            try:
+                results.append((yield pool))
+            except yieldpoints.TimeoutException as e:
+                timed_out.append(e.args[0])
+
+        self.assertEqual([(0, 0), (2, 20)], results)
+        self.assertEqual([1], timed_out)
+
+    @gen_test
+    def test_deadline(self):
+        @gen.engine
+        def test(callback):
+            operation = Operation(
+                self.io_loop, [(0.01, 0), (1, 10), (1, 20), (1, 30)])
+            pool = yieldpoints.Pool(
+                operation, range(4), 2, deadline=timedelta(seconds=0.05),
+                io_loop=self.io_loop)
+
+            results = []
+            try:
+                while pool:
+                    results.append((yield pool))
+            except yieldpoints.TimeoutException as e:
+                self.assertEqual((), e.args)
+            else:
+                self.fail("No TimeoutException raised")
+
+            self.assertFalse(pool)
+            callback(results)
+
+        start = time.time()
+        try:
+            results = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertTrue(abs(time.time() - start - 0.05) < 0.02)
+        self.assertEqual([(0, 0)], results)
+
+    @gen_test
+    def test_inherited_deadline(self):
+        @gen.engine
+        def test(callback):
+            operation = Operation(
+                self.io_loop, [(0.01, 0), (1, 10), (1, 20)])
+            pool = yieldpoints.Pool(operation, range(3), 2,
+                                    io_loop=self.io_loop)
+
+            results = []
+            try:
+                while pool:
+                    results.append((yield pool))
+            except yieldpoints.TimeoutException as e:
+                self.assertEqual((), e.args)
+            else:
+                self.fail("No TimeoutException raised")
+
+            callback(results)
+
+        deadline = yieldpoints.Deadline(
+            timedelta(seconds=0.05), self.io_loop)
+        start = time.time()
+        results = yield gen.Task(yieldpoints.run_with_deadline, deadline, test)
+        self.assertTrue(abs(time.time() - start - 0.05) < 0.02)
+        self.assertEqual([(0, 0)], results)
+
+
+class TestCancel(AsyncTestCase):
+    @gen_test
+    def test_cancel(self):
+        @gen.engine
+        def test(callback):
+            yield gen.Callback('key') # never called
+            yield yieldpoints.Cancel('key')
+            callback()
+
+        try:
+            yield gen.Task(test)
+            pass
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+    @gen_test
+    def test_cancel_unknown_key(self):
+        @gen.engine
+        def test(callback):
+            yield yieldpoints.Cancel('key')
+            callback()
+
+        try:
+            yield gen.Task(test)
+        except gen.UnknownKeyError:
+            # Success
+            pass
+        else:
+            self.fail("UnknownKeyError not raised")
+
+    @gen_test
+    def test_callback_after_cancel(self):
+        # Check that a canceled callback can still be run without error
+        key_callback = yield gen.Callback('key')
+        yield yieldpoints.Cancel('key')
+        key_callback()
+
+
+class TestAbort(AsyncTestCase):
+    @gen_test
+    def test_cancel(self):
+        aborted = []
+        callback = yield yieldpoints.Callback(
+            'key', partial(aborted.append, 'key'))
+        yield yieldpoints.Cancel('key')
+        self.assertEqual(['key'], aborted)
+        callback() # No error
+
+    @gen_test
+    def test_cancel_all(self):
+        aborted = []
+        for key in range(3):
+            yield yieldpoints.Callback(key, partial(aborted.append, key))
+
+        yield yieldpoints.CancelAll()
+        self.assertEqual([0, 1, 2], sorted(aborted))
+
+    @gen_test
+    def test_completed(self):
+        # No abort once the operation is complete
+        aborted = []
+        (yield yieldpoints.Callback('key', partial(aborted.append, 'key')))()
+        yield gen.Wait('key')
+
+        (yield yieldpoints.Callback('key', partial(aborted.append, 'key')))()
+        yield yieldpoints.Cancel('key')
+        self.assertEqual([], aborted)
+
+    @gen_test
+    def test_timeout(self):
+        @gen.engine
+        def test(callback):
+            token = yieldpoints.CancelToken()
+            yield yieldpoints.Callback(0, token)
+            token.add_hook(partial(aborted.append, 0))
+            yield yieldpoints.Callback(1, partial(aborted.append, 1))
+            try:
+                yield yieldpoints.WithTimeout(
+                    timedelta(seconds=0.01), yieldpoints.WaitAny([0, 1]),
+                    self.io_loop, cancel=True)
+            except yieldpoints.TimeoutException:
+                callback()
+
+        aborted = []
+        try:
+            yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual([0, 1], sorted(aborted))
+
+    @gen_test
+    def test_timeout_key(self):
+        aborted = []
+        yield yieldpoints.Callback('key', partial(aborted.append, 'key'))
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), 'key', self.io_loop, cancel=True)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        self.assertEqual(['key'], aborted)
+
+    def test_cancel_token(self):
+        token = yieldpoints.CancelToken()
+        aborted = []
+        token.add_hook(partial(aborted.append, 1))
+        token()
+        token()
+        token.add_hook(partial(aborted.append, 2))
+        self.assertEqual([1, 2], aborted)
+        self.assertTrue(token.aborted)
+
+
+class TestGroups(AsyncTestCase):
+    @gen_test
+    def test_wait_any_in_group(self):
+        callbacks = {}
+        for key in range(4):
+            group = 'even' if key % 2 == 0 else 'odd'
+            yield_point = yieldpoints.Callback(key, group=group)
+            callbacks[key] = yield yield_point
+
+        runner = yield_point.runner
+
+        callbacks[1]('b')
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(callbacks[2], 'c'))
+
+        self.assertEqual((2, 'c'), (yield yieldpoints.WaitAnyInGroup('even')))
+        self.assertEqual((1, 'b'), (yield yieldpoints.WaitAnyInGroup('odd')))
+        self.assertEqual(set([0]), runner.results.groups['even'])
+        self.assertEqual(set([3]), runner.results.groups['odd'])
+
+        yield yieldpoints.CancelAll()
+
+    @gen_test
+    def test_cancel_group(self):
+        @gen.engine
+        def test(callback):
+            aborted = []
+            for key in range(4):
+                group = 'even' if key % 2 == 0 else 'odd'
+                yield yieldpoints.Callback(
+                    key, partial(aborted.append, key), group)
+
+            yield yieldpoints.CancelGroup('even')
+            self.assertEqual([0, 2], sorted(aborted))
+            yield yieldpoints.CancelGroup('odd')
+            yield yieldpoints.CancelGroup('unknown')
+            callback(aborted)
+
+        try:
+            aborted = yield gen.Task(test)
+        except gen.LeakedCallbackError:
+            self.fail("LeakedCallbackError was unexpectedly raised")
+
+        self.assertEqual([0, 1, 2, 3], sorted(aborted))
+
+    @gen_test
+    def test_timeout(self):
+        yield yieldpoints.Callback('key', group='group')
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), yieldpoints.WaitAnyInGroup('group'),
+                self.io_loop, cancel=True)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+
+class TestSubmit(AsyncTestCase):
+    def setUp(self):
+        super(TestSubmit, self).setUp()
+        self.executor = ThreadPoolExecutor(1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(TestSubmit, self).tearDown()
+
+    @gen_test
+    def test_submit(self):
+        callback = yield gen.Callback('callback')
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.05), partial(callback, 'callback'))
+
+        yield yieldpoints.Submit(
+            'thread', self.executor, partial(sum, [1, 2]), self.io_loop)
+
+        history = []
+        keys = ['thread', 'callback']
+        while keys:
+            key, result = yield yieldpoints.WaitAny(keys)
+            history.append((key, result))
+            keys.remove(key)
+
+        self.assertEqual([('thread', 3), ('callback', 'callback')], history)
+
+    @gen_test
+    def test_exception(self):
+        yield yieldpoints.Submit(
+            'thread', self.executor, partial(divmod, 1, 0), self.io_loop)
+        result = yield yieldpoints.WithTimeout(
+            timedelta(seconds=1), 'thread', self.io_loop)
+
+        self.assertTrue(isinstance(result, ZeroDivisionError))
+
+    @gen_test
+    def test_cancel(self):
+        # Occupy the executor's thread so the next submission is queued
+        yield yieldpoints.Submit(
+            'sleep', self.executor, partial(time.sleep, 0.05), self.io_loop)
+        future = yield yieldpoints.Submit(
+            'queued', self.executor, partial(sum, [1]), self.io_loop)
+
+        yield yieldpoints.Cancel('queued')
+        self.assertTrue(future.cancelled())
+        yield gen.Wait('sleep')
+
+
+if ThreadPoolExecutor is None:
+    # No concurrent.futures. Not unittest.skipIf, which is new in Python 2.7.
+    del TestSubmit
+
+
+class FakeHandler(object):
+    def __init__(self):
+        self.output = []
+        self.flushed = []
+        self.flush_callback = None
+        self.finished = False
+
+    def write(self, chunk):
+        self.output.append(chunk)
+
+    def flush(self, callback=None):
+        self.flushed.append(''.join(self.output))
+        self.output = []
+        self.flush_callback = callback
+
+    def finish(self, chunk=None):
+        if chunk is not None:
+            self.write(chunk)
+        self.flush()
+        self.finished = True
+
+
+class TestCoalescingWriter(AsyncTestCase):
+    def complete_flush(self, handler):
+        callback, handler.flush_callback = handler.flush_callback, None
+        callback()
+
+    @gen_test
+    def test_max_delay(self):
+        handler = FakeHandler()
+        writer = yieldpoints.CoalescingWriter(
+            handler, max_delay=0.01, io_loop=self.io_loop)
+
+        for chunk in 'abc':
+            yield writer.write(chunk)
+
+        self.assertEqual([], handler.flushed)
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.02))
+        self.assertEqual(['abc'], handler.flushed)
+
+        # Written during the flush, sent when it completes
+        yield writer.write('d')
+        self.complete_flush(handler)
+        self.assertEqual(['abc', 'd'], handler.flushed)
+        self.complete_flush(handler)
+
+        writer.finish('e')
+        self.assertEqual(['abc', 'd', 'e'], handler.flushed)
+        self.assertTrue(handler.finished)
+        self.assertEqual(None, writer.timeout)
+
+    @gen_test
+    def test_max_bytes(self):
+        handler = FakeHandler()
+        writer = yieldpoints.CoalescingWriter(
+            handler, max_bytes=4, max_delay=10, io_loop=self.io_loop)
+
+        yield writer.write('ab')
+        self.assertEqual([], handler.flushed)
+        yield writer.write('cd')
+        self.assertEqual(['abcd'], handler.flushed)
+        self.assertEqual(None, writer.timeout)
+        self.assertEqual(1, writer.flushes)
+
+    @gen_test
+    def test_backpressure(self):
+        handler = FakeHandler()
+        writer = yieldpoints.CoalescingWriter(
+            handler, max_bytes=2, high_water=4, io_loop=self.io_loop)
+
+        yield writer.write('ab')
+        self.assertTrue(writer.flushing)
+        yield writer.write('cd')
+        self.assertEqual(['ab'], handler.flushed)
+
+        # Waits for the flush in flight
+        self.io_loop.add_timeout(
+            timedelta(seconds=0.01), partial(self.complete_flush, handler))
+        start = time.time()
+        yield writer.write('ef')
+        self.assertTrue(time.time() - start >= 0.009)
+        self.assertEqual(['ab', 'cdef'], handler.flushed)
+        self.assertEqual([], writer.waiters)
+        self.complete_flush(handler)
+
+
+class TestRateLimiter(AsyncTestCase):
+    @gen_test
+    def test_burst(self):
+        limiter = yieldpoints.RateLimiter(
+            rate=100, burst=3, io_loop=self.io_loop)
+
+        start = time.time()
+        for _ in range(3):
+            yield limiter.acquire()
+        self.assertTrue(time.time() - start < 0.005)
+        self.assertFalse(limiter.try_acquire())
+
+        yield limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.009)
+        self.assertRaises(ValueError, limiter.acquire, 4)
+
+    @gen_test
+    def test_one_timeout(self):
+        wheel = yieldpoints.TimerWheel(slack=0.001, io_loop=self.io_loop)
+        limiter = yieldpoints.RateLimiter(
+            rate=200, io_loop=self.io_loop, timer_wheel=wheel)
+        order = []
+
+        @gen.coroutine
+        def worker(i):
+            yield limiter.acquire()
+            order.append(i)
+
+        self.assertTrue(limiter.try_acquire())
+        futures = [worker(i) for i in range(5)]
+        self.assertEqual(5, len(limiter.waiters))
+        self.assertEqual(1, len(wheel))
+
+        start = time.time()
+        yield futures
+        self.assertEqual(list(range(5)), order)
+        self.assertTrue(time.time() - start >= 0.02)
+        self.assertEqual(None, limiter.timeout)
+
+    @gen_test
+    def test_with_timeout(self):
+        limiter = yieldpoints.RateLimiter(rate=10, io_loop=self.io_loop)
+        yield limiter.acquire()
+
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), limiter.acquire(),
+                io_loop=self.io_loop, cancel=True)
+        except yieldpoints.TimeoutException:
+            pass
+        else:
+            self.fail("TimeoutException not raised")
+
+        # The waiter was withdrawn, and its timeout removed
+        self.assertEqual(0, len(limiter.waiters))
+        self.assertEqual(None, limiter.timeout)
+
+        # The next caller waits for the token the withdrawn one didn't take
+        start = time.time()
+        yield limiter.acquire()
+        self.assertTrue(0.05 < time.time() - start < 0.1)
+
+
+class TestCancelAll(AsyncTestCase):
+    @gen_test
+    def test_timeout(self):
+        @gen.engine
+        def test(callback):
+            for i in range(2):
+                yield gen.Callback(i) # never called
+            yield yieldpoints.CancelAll()
+            callback()
+
+        try:
+            yield gen.Task(test)
         except gen.LeakedCallbackError:
             self.fail("LeakedCallbackError was unexpectedly raised")
+
+
+class TestFutures(AsyncTestCase):
+    def resolve_later(self, future, seconds, result):
+        self.io_loop.add_timeout(
+            timedelta(seconds=seconds), partial(future.set_result, result))
+
+    @gen_test
+    def test_wait_any(self):
+        f0, f1 = Future(), Future()
+        self.resolve_later(f0, 0.02, 'a')
+        self.resolve_later(f1, 0.01, 'b')
+        self.assertEqual((f1, 'b'), (yield futures.wait_any([f0, f1])))
+
+        f0, f1 = Future(), Future()
+        self.resolve_later(f0, 0.01, 'a')
+        self.resolve_later(f1, 0.02, 'b')
+        result = yield futures.wait_any({'key0': f0, 'key1': f1})
+        self.assertEqual(('key0', 'a'), result)
+
+    @gen_test
+    def test_wait_any_exception(self):
+        future = Future()
+        future.set_exception(ZeroDivisionError())
+        try:
+            yield futures.wait_any([future, Future()])
+        except ZeroDivisionError:
+            # Expected
+            pass
+        else:
+            self.fail("No ZeroDivisionError raised")
+
+    @gen_test
+    def test_as_completed(self):
+        fs = [Future() for _ in range(3)]
+        self.resolve_later(fs[0], 0.03, 'a')
+        self.resolve_later(fs[1], 0.01, 'b')
+        self.resolve_later(fs[2], 0.02, 'c')
+
+        history = []
+        for next_future in futures.as_completed(fs):
+            key, result = yield next_future
+            history.append(result)
+
+        self.assertEqual(['b', 'c', 'a'], history)
+
+    @gen_test
+    def test_with_timeout(self):
+        start = time.time()
+        try:
+            yield futures.with_timeout(
+                timedelta(seconds=0.1), Future(), self.io_loop)
+        except yieldpoints.TimeoutException:
+            # Expected
+            pass
+        else:
+            self.fail("No TimeoutException raised")
+
+        duration = time.time() - start
+        self.assertTrue(abs(duration - 0.1) < 0.02)
+
+        future = Future()
+        self.resolve_later(future, 0.01, 'result')
+        result = yield futures.with_timeout(
+            timedelta(seconds=0.1), future, self.io_loop)
+
+        self.assertEqual('result', result)
+
+    def test_cancel_all(self):
+        fs = [Future() for _ in range(2)]
+        fs[0].set_result(None)
+        futures.cancel_all(fs)
+        self.assertFalse(fs[0].cancelled())
+        # Without the "futures" package Python 2 Futures can't be canceled
+        self.assertEqual(fs[1].cancel(), fs[1].cancelled())
+
+
+class TestAsyncioFutures(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def resolve_later(self, future, seconds, result):
+        self.loop.call_later(seconds, future.set_result, result)
+
+    def test_wait_any(self):
+        f0, f1 = self.loop.create_future(), self.loop.create_future()
+        self.resolve_later(f0, 0.02, 'a')
+        self.resolve_later(f1, 0.01, 'b')
+        wait_future = futures.wait_any([f0, f1])
+        self.assertTrue(isinstance(wait_future, asyncio.Future))
+        self.assertEqual(
+            (f1, 'b'), self.loop.run_until_complete(wait_future))
+
+    def test_with_timeout(self):
+        future = self.loop.create_future()
+        with_timeout = futures.with_timeout(timedelta(seconds=0.01), future)
+        self.assertRaises(yieldpoints.TimeoutException,
+                          self.loop.run_until_complete, with_timeout)
+
+        future = self.loop.create_future()
+        self.resolve_later(future, 0.01, 'result')
+        with_timeout = futures.with_timeout(time.time() + 0.1, future)
+        self.assertEqual('result', self.loop.run_until_complete(with_timeout))
+
+    def test_cancel(self):
+        future = self.loop.create_future()
+        self.assertTrue(futures.cancel(future))
+        self.assertTrue(future.cancelled())
+        wait_future = futures.wait_any([future])
+        self.assertRaises(asyncio.CancelledError,
+                          self.loop.run_until_complete, wait_future)
+
+
+if asyncio is None:
+    # No asyncio. Not unittest.skipIf, which is new in Python 2.7.
+    del TestAsyncioFutures
+
+
+class RecordingCollector(metrics.Collector):
+    def __init__(self):
+        self.events = []
+
+    def start(self, yield_point):
+        self.events.append(('start', type(yield_point).__name__))
+
+    def ready(self, yield_point, waited):
+        self.events.append(('ready', type(yield_point).__name__))
+
+    def result(self, yield_point, waited):
+        self.events.append(('result', type(yield_point).__name__))
+
+    def expire(self, yield_point, waited):
+        self.events.append(('expire', type(yield_point).__name__))
+
+    def cancel(self, runner, key):
+        self.events.append(('cancel', key))
+
+
+class TestMetrics(AsyncTestCase):
+    def tearDown(self):
+        metrics.set_collector(None)
+        super(TestMetrics, self).tearDown()
+
+    @gen_test
+    def test_hooks(self):
+        collector = RecordingCollector()
+        metrics.set_collector(collector)
+        (yield gen.Callback('a'))()
+        yield yieldpoints.WaitAny(['a'])
+        yield gen.Callback('b') # never called
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.01), 'b', self.io_loop)
+        except yieldpoints.TimeoutException:
+            pass
+
+        yield yieldpoints.Cancel('b')
+        self.assertEqual([
+            ('start', 'WaitAny'),
+            ('ready', 'WaitAny'),
+            ('result', 'WaitAny'),
+            ('start', 'WithTimeout'),
+            ('expire', 'WithTimeout'),
+            ('cancel', 'b')], collector.events)
+
+    @gen_test
+    def test_histogram_collector(self):
+        collector = metrics.HistogramCollector()
+        metrics.set_collector(collector)
+        for i in range(10):
+            callback = yield gen.Callback(i)
+            self.io_loop.add_timeout(timedelta(seconds=0.01), callback)
+            yield metrics.label(yieldpoints.WaitAny([i]), 'label')
+
+        (yield gen.Callback('key'))()
+        yield yieldpoints.WaitAny(['key'])
+
+        snapshot = collector.snapshot()
+        stats = snapshot['WaitAny:label']
+        self.assertEqual(10, stats['start'])
+        self.assertEqual(10, stats['result'])
+        self.assertTrue(0.009 < stats['p50'] < 0.02)
+        self.assertEqual(1, snapshot['WaitAny']['result'])
+
+
+class TestDebug(AsyncTestCase):
+    def setUp(self):
+        super(TestDebug, self).setUp()
+        debug.enable()
+
+    def tearDown(self):
+        debug.disable()
+        super(TestDebug, self).tearDown()
+
+    @gen_test
+    def test_snapshot(self):
+        line = current_line() + 1
+        callback = yield gen.Callback('key')
+        yield gen.Callback('other')
+        callback('x' * 1000)
+
+        pending = dict((p.key, p) for p in debug.snapshot())
+        self.assertEqual(set(['key', 'other']), set(pending))
+        self.assertEqual(
+            '%s:%d' % (__file__.replace('.pyc', '.py'), line),
+            pending['key'].site)
+        self.assertTrue(pending['key'].result_size >= 1000)
+        self.assertEqual(None, pending['other'].result_size)
+
+        yield gen.Wait('key')
+        yield yieldpoints.Cancel('other')
+        self.assertEqual([], debug.snapshot())
+
+    @gen_test
+    def test_leaks(self):
+        yield gen.Callback('key')
+        self.assertEqual([], debug.leaks())
+        yield gen.Task(self.io_loop.add_timeout, timedelta(seconds=0.01))
+        leaks = debug.leaks(threshold=0.01)
+        self.assertEqual(['key'], [p.key for p in leaks])
+        self.assertEqual(
+            ['key'], [p.key for p in debug.check(threshold=0.01)])
+        yield yieldpoints.CancelAll()
+
+    @gen_test
+    def test_prune(self):
+        for i in range(100):
+            yield gen.Callback(i)
+            yield yieldpoints.Cancel(i)
+
+        records = list(debug._registry.values())
+        self.assertTrue(max(len(r) for r in records) <= 16 + 1)
+
+    def test_disable(self):
+        register_callback = gen.Runner.register_callback
+        debug.disable()
+        self.assertFalse(debug.enabled())
+        self.assertNotEqual(register_callback, gen.Runner.register_callback)
+        self.assertEqual([], debug.snapshot())
+
+
+def current_line():
+    return sys._getframe(1).f_lineno
+
+
+class TestTracing(AsyncTestCase):
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        metrics.set_collector(None)
+        os.remove(self.path)
+        super(TestTracing, self).tearDown()
+
+    @gen_test
+    def test_trace(self):
+        collector = tracing.TraceCollector(self.path)
+        metrics.set_collector(collector)
+
+        @gen.coroutine
+        def request():
+            callbacks = []
+            for key in ['fast', 'slow']:
+                callbacks.append((yield gen.Callback(key)))
+
+            self.io_loop.add_timeout(timedelta(seconds=0.01), callbacks[0])
+            self.io_loop.add_timeout(timedelta(seconds=0.03), callbacks[1])
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=1), yieldpoints.WaitAny(['fast', 'slow']),
+                self.io_loop)
+            yield yieldpoints.WaitAny(['slow'])
+
+            yield gen.Callback('never')
+            yield yieldpoints.Cancel('never')
+
+        yield tracing.run_traced('my request', request)
+
+        # Readable while the array is still open
+        collector.flush()
+        events = tracing.load(self.path)
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(
+            ['WaitAny', 'WithTimeout', 'WaitAny'], [e['name'] for e in spans])
+        self.assertEqual("'fast'", spans[1]['args']['winner'])
+        self.assertEqual(["'fast'", "'slow'"], spans[1]['args']['keys'])
+        self.assertFalse(spans[1]['args']['timed_out'])
+        self.assertEqual(1, len(set(e['tid'] for e in spans)))
+
+        cancels = [e for e in events if e['name'] == 'Cancel']
+        self.assertEqual("'never'", cancels[0]['args']['key'])
+
+        collector.close()
+        path = tracing.critical_path(tracing.load(self.path))['my request']
+
+        # The nested WaitAny is left out
+        self.assertEqual(['WithTimeout', 'WaitAny'], [s['name'] for s in path])
+        self.assertEqual("'slow'", path[1]['args']['winner'])
+
+    @gen_test
+    def test_untraced_cancel(self):
+        collector = tracing.TraceCollector(self.path)
+        metrics.set_collector(collector)
+
+        @gen.coroutine
+        def request(key):
+            (yield gen.Callback(key))()
+            yield yieldpoints.WaitAny([key])
+            yield gen.Callback(key)
+            yield yieldpoints.Cancel(key)
+
+        # Each coroutine is its own request, including its Cancel events
+        yield [request('a'), request('b')]
+        collector.close()
+        events = tracing.load(self.path)
+        tids = {}
+        for event in events:
+            if event['name'] in ('WaitAny', 'Cancel'):
+                key = event['args'].get('key') or event['args']['winner']
+                tids.setdefault(key, set()).add(event['tid'])
+
+        self.assertEqual(1, len(tids["'a'"]))
+        self.assertEqual(1, len(tids["'b'"]))
+        self.assertNotEqual(tids["'a'"], tids["'b'"])
+
+    def test_critical_path(self):
+        def span(name, start, duration):
+            return {'name': name, 'ph': 'X', 'ts': start, 'dur': duration,
+                    'tid': 1, 'args': {}}
+
+        # a and b overlap, c follows b
+        events = [span('a', 0, 10), span('b', 5, 20), span('c', 26, 4),
+                  span('inside', 6, 2)]
+        path = tracing.critical_path(events)[1]
+        self.assertEqual(['b', 'c'], [s['name'] for s in path])
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentile(self):
+        histogram = metrics.Histogram()
+        self.assertEqual(None, histogram.percentile(50))
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+
+        self.assertEqual(1000, histogram.count)
+        for p in (1, 50, 90, 99):
+            expected = p / 100.0
+            # Within the relative error of 16 sub-buckets per power of two
+            self.assertTrue(
+                abs(histogram.percentile(p) - expected) <= expected / 16)
+
+        self.assertEqual(1.0, histogram.percentile(100))
+        self.assertEqual(0.001, histogram.percentile(0))
+
+    def test_small_values(self):
+        histogram = metrics.Histogram(unit=1e-3)
+        histogram.add(0)
+        histogram.add(1e-9)
+        self.assertEqual(2, histogram.count)
+        self.assertTrue(histogram.percentile(50) <= 1e-9)
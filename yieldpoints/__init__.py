@@ -1,9 +1,23 @@
+from bisect import bisect_left, insort
+from collections import deque
+from datetime import timedelta
 from functools import partial
+import itertools
+import math
+import random
 
-from tornado import gen
+from tornado import gen, stack_context
 from tornado.gen import UnknownKeyError
 from tornado.ioloop import IOLoop
 
+from yieldpoints import metrics
+from yieldpoints.policies import (FIFOPolicy, PriorityPolicy, RandomPolicy,
+                                  RoundRobinPolicy)
+from yieldpoints.queues import Queue, QueueEmpty, QueueFull
+from yieldpoints.timers import (Deadline, TimerWheel, cancel_deadline,
+                                run_with_deadline, schedule_deadline,
+                                timedelta_to_seconds)
+
 
 version_tuple = (0, 1, '+')
 
@@ -12,41 +26,553 @@ version = '.'.join(map(str, version_tuple))
 
 
 __all__ = [
-    'TimeoutException', 'WaitAny', 'WithTimeout', 'Timeout', 'Cancel',
-    'CancelAll'
+    'TimeoutException', 'WaitAny', 'WaitSome', 'WaitN', 'AsCompleted',
+    'WithTimeout', 'Timeout', 'Cancel', 'CancelAll', 'TimerWheel', 'Hedge',
+    'LatencyWindow', 'Pool', 'Deadline', 'run_with_deadline', 'Callback',
+    'CancelToken', 'WaitAnyInGroup', 'CancelGroup', 'Submit', 'Retry',
+    'SingleFlight', 'FIFOPolicy', 'RandomPolicy', 'PriorityPolicy',
+    'RoundRobinPolicy', 'Queue', 'QueueEmpty', 'QueueFull', 'Get', 'Put',
+    'Select', 'Gather', 'AdaptiveTimeout', 'CircuitBreaker',
+    'CircuitOpenError', 'CoalescingWriter', 'RateLimiter'
 ]
 
 
+class _ResultDict(dict):
+    """Replacement for ``runner.results`` that tells watchers when a key's
+    result arrives, so they needn't rescan every key on each wakeup.
+
+    A watcher has ``key_completed(key)`` and ``key_canceled(key)`` methods.
+    Each key has at most one watcher, which is dropped once it's notified.
+
+    Results for keys that aren't pending, because they were canceled, are
+    discarded instead of kept forever.
+
+    ``abort_hooks`` maps keys to the functions :func:`cancel` calls to abort
+    their operations. A key's hook is dropped once its result arrives.
+
+    ``groups`` maps group names to sets of pending keys. A key leaves its
+    group when its result is popped or it's canceled.
+
+    ``completed`` maps keys with results to a sequence number, in the order
+    their results arrived.
+    """
+    def __init__(self, runner):
+        dict.__init__(self, runner.results)
+        self.runner = runner
+        self.watchers = {}
+        self.abort_hooks = {}
+        self.groups = {}
+        self.key_groups = {}
+        self.completed = {}
+        self.sequence = itertools.count()
+        # Results that arrived before this replaced runner.results, in the
+        # order they arrived if the dict keeps insertion order.
+        for key in runner.results:
+            self.completed[key] = next(self.sequence)
+
+    def pop(self, key, *default):
+        self.completed.pop(key, None)
+        group = self.key_groups.pop(key, None)
+        if group is not None:
+            keys = self.groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.groups[group]
+
+        return dict.pop(self, key, *default)
+
+    def add_to_group(self, key, group):
+        self.key_groups[key] = group
+        self.groups.setdefault(group, set()).add(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.runner.pending_callbacks:
+            return
+
+        dict.__setitem__(self, key, value)
+        self.completed[key] = next(self.sequence)
+        self.abort_hooks.pop(key, None)
+        watcher = self.watchers.pop(key, None)
+        if watcher is not None:
+            watcher.key_completed(key)
+
+
+def _result_dict(runner):
+    if not isinstance(runner.results, _ResultDict):
+        runner.results = _ResultDict(runner)
+    return runner.results
+
+
 def cancel(runner, key):
     try:
         runner.pending_callbacks.remove(key)
     except KeyError:
         raise UnknownKeyError("key %r is not pending" % key)
 
+    results = _result_dict(runner)
+    results.pop(key, None)
+    watcher = results.watchers.pop(key, None)
+    if watcher is not None:
+        watcher.key_canceled(key)
+
+    if metrics.collector is not None:
+        metrics.canceled(runner, key)
+
+    abort = results.abort_hooks.pop(key, None)
+    if abort is not None:
+        abort()
+
+
+class CancelToken(object):
+    """Collects hooks that abort an operation, for use as the `abort`
+    argument to :class:`Callback`.
+
+    Pass a ``CancelToken`` to the operation, which adds a hook once it has
+    something to abort, such as a stream to close. Calling the token runs
+    the hooks, once; hooks added afterward run immediately.
+    """
+    def __init__(self):
+        self.hooks = []
+        self.aborted = False
+
+    def add_hook(self, hook):
+        if self.aborted:
+            hook()
+        else:
+            self.hooks.append(hook)
+
+    def __call__(self):
+        if not self.aborted:
+            self.aborted = True
+            hooks, self.hooks = self.hooks, []
+            for hook in hooks:
+                hook()
+
+
+class Callback(gen.Callback):
+    """Like ``gen.Callback``, but with a function that aborts the operation
+    if the key is canceled.
+
+    :class:`Cancel`, :class:`CancelAll`, and :class:`WithTimeout` with
+    ``cancel=True`` call `abort` if the key is still pending, so the
+    operation's connection or other resources are freed right away::
+
+        token = yieldpoints.CancelToken()
+        fetch(url, callback=(yield yieldpoints.Callback(url, token)),
+              cancel_token=token)
+
+    Keys can be put in a named group, to wait on or cancel together with
+    :class:`WaitAnyInGroup` and :class:`CancelGroup`.
+
+    :Parameters:
+      - `key`: The key, as for ``gen.Callback``
+      - `abort`: Optional function, such as a :class:`CancelToken`
+      - `group`: Optional group name
+    """
+    def __init__(self, key, abort=None, group=None):
+        super(Callback, self).__init__(key)
+        self.abort = abort
+        self.group = group
+
+    def start(self, runner):
+        super(Callback, self).start(runner)
+        results = _result_dict(runner)
+        if self.abort is not None:
+            results.abort_hooks[self.key] = self.abort
+        if self.group is not None:
+            results.add_to_group(self.key, self.group)
+
+
+class Submit(gen.YieldPoint):
+    """Run a function on a ``concurrent.futures`` executor, and deliver its
+    result under a key.
+
+    Like ``gen.Callback``, yielding a ``Submit`` registers `key` and continues
+    at once, so the function's result can be waited for with
+    :class:`WaitAny` or :class:`WithTimeout` alongside other keys::
+
+        yield yieldpoints.Submit('parse', executor, partial(parse, body))
+        fetch(url, callback=(yield gen.Callback('fetch')))
+        key, result = yield yieldpoints.WaitAny(['parse', 'fetch'])
+
+    The result is passed back to the ``IOLoop``'s thread. If the function
+    raises, the exception is the key's result. Canceling the key cancels the
+    executor's future if it hasn't started running. The yield returns that
+    future.
+
+    :Parameters:
+      - `key`: The key, as for ``gen.Callback``
+      - `executor`: A ``ThreadPoolExecutor``, ``ProcessPoolExecutor``, or
+        similar
+      - `fn`: A function of no arguments, such as a ``functools.partial``
+      - `io_loop`: Optional custom ``IOLoop`` to deliver the result on
+    """
+    def __init__(self, key, executor, fn, io_loop=None):
+        self.key = key
+        self.executor = executor
+        self.fn = fn
+        self.io_loop = io_loop or IOLoop.instance()
+        self.future = None
+
+    def start(self, runner):
+        runner.register_callback(self.key)
+        callback = runner.result_callback(self.key)
+        io_loop = self.io_loop
+
+        def done(future):
+            # Runs on the executor's thread.
+            if future.cancelled():
+                return
+
+            exception = future.exception()
+            if exception is not None:
+                io_loop.add_callback(callback, exception)
+            else:
+                io_loop.add_callback(callback, future.result())
+
+        self.future = self.executor.submit(self.fn)
+        _result_dict(runner).abort_hooks[self.key] = self.future.cancel
+        self.future.add_done_callback(done)
+
+    def is_ready(self):
+        return True
+
+    def get_result(self):
+        return self.future
+
 
 class TimeoutException(Exception):
     pass
 
 
+class CircuitOpenError(Exception):
+    """Raised by a :class:`CircuitBreaker` call when the circuit is open."""
+
+
+class _ReadyKeys(object):
+    """A policy's ready queue and watchers for the keys of a loop of
+    :class:`WaitAny` waits.
+
+    It's kept on the policy across waits, so a wait costs O(log n) instead of
+    a scan of the keys. It's rebuilt if the keys change in any way other
+    than losing the keys it returned or that were canceled.
+    """
+    def __init__(self, policy, runner, keys):
+        self.runner = runner
+        self.keys = keys
+        self.queue = policy.queue(keys)
+        self.n_keys = len(keys)
+        self.watched = set()
+        results = _result_dict(runner)
+        ready_keys = []
+        for key in keys:
+            if runner.is_ready(key):
+                ready_keys.append(key)
+            else:
+                results.watchers[key] = self
+                self.watched.add(key)
+
+        completed = results.completed
+        ready_keys.sort(key=lambda key: completed.get(key, -1))
+        for key in ready_keys:
+            self.queue.push(key)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def matches(self, runner, keys):
+        return (runner is self.runner and keys is self.keys
+                and len(keys) == self.n_keys)
+
+    def key_completed(self, key):
+        self.watched.discard(key)
+        self.queue.push(key)
+
+    def key_canceled(self, key):
+        self.watched.discard(key)
+        self.n_keys -= 1
+
+    def pop(self):
+        """Choose a ready key, or return None."""
+        runner = self.runner
+        while self.queue:
+            key = self.queue.pop()
+            self.n_keys -= 1
+            if key in runner.pending_callbacks and key in runner.results:
+                return key
+            # Else canceled after it completed.
+
+        return None
+
+    def detach(self):
+        watchers = self.runner.results.watchers
+        for key in self.watched:
+            if watchers.get(key) is self:
+                del watchers[key]
+        self.watched.clear()
+
+
 class WaitAny(gen.YieldPoint):
     """Wait for several keys, and continue when the first of them is complete.
 
     Inspired by Ben Darnell in `a conversation on the Tornado mailing list
     <https://groups.google.com/d/msg/python-tornado/PCHidled01M/B7sDjNP2OpQJ>`_.
+
+    A ``WaitAny`` can be yielded again, and waits for the keys in `keys` at
+    that time, so a loop can remove keys from the list as they complete
+    instead of allocating a ``WaitAny`` each time.
+
+    If several keys are ready, the first in the order of `keys` is
+    returned, so under load the first keys can starve the rest. Pass a
+    policy to choose otherwise, such as a :class:`RoundRobinPolicy` shared
+    by a loop's waits to take turns. With a policy, completions are queued
+    as they arrive and one is chosen in O(log n). The queue is kept on the
+    policy, so use one policy per loop; a wait costs O(log n) as long as the
+    only keys removed between waits are those returned or canceled. Other
+    changes to the keys, like adding one, cost a scan of the keys.
+
+    :Parameters:
+      - `keys`: Keys to wait for
+      - `policy`: Optional :class:`FIFOPolicy`, :class:`RandomPolicy`,
+        :class:`PriorityPolicy`, or :class:`RoundRobinPolicy`
     """
-    def __init__(self, keys):
+    policy = None
+    ready = None
+
+    def __init__(self, keys, policy=None):
         self.keys = keys
+        self.policy = policy
 
     def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
         self.runner = runner
+        if self.policy is not None:
+            ready = getattr(self.policy, 'ready_keys', None)
+            if ready is None or not ready.matches(runner, self.keys):
+                if ready is not None:
+                    ready.detach()
+                ready = _ReadyKeys(self.policy, runner, self.keys)
+                self.policy.ready_keys = ready
+            self.ready = ready
 
     def is_ready(self):
+        if self.ready is not None:
+            return bool(self.ready)
         return any(self.runner.is_ready(key) for key in self.keys)
 
     def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        if self.ready is not None:
+            return self._pop_ready()
+
+        for key in self.keys:
+            if self.runner.is_ready(key):
+                result = key, self.runner.pop_result(key)
+                if metrics.collector is not None:
+                    metrics.finished(self, winner=key)
+                return result
+        raise Exception("no results found")
+
+    def _pop_ready(self):
+        key = self.ready.pop()
+        if key is None:
+            raise Exception("no results found")
+
+        result = key, self.runner.pop_result(key)
+        if metrics.collector is not None:
+            metrics.finished(self, winner=key)
+        return result
+
+
+class WaitAnyInGroup(WaitAny):
+    """Wait for the keys in a group, and continue when the first of them is
+    complete.
+
+    Like :class:`WaitAny`, but waits for the pending keys registered in
+    `group` with :class:`Callback`. Its cost is proportional to the size of
+    the group, not to the number of keys the coroutine has pending.
+    """
+    def __init__(self, group, policy=None):
+        self.group = group
+        self.policy = policy
+
+    @property
+    def keys(self):
+        return self.runner.results.groups.get(self.group, ())
+
+    def start(self, runner):
+        _result_dict(runner)
+        super(WaitAnyInGroup, self).start(runner)
+
+
+class WaitSome(WaitAny):
+    """Wait for several keys, and continue with all that are complete.
+
+    Returns a list of ``(key, result)`` pairs, in the order of `keys`, for
+    every key that is complete when the coroutine resumes. When many keys
+    complete at once this takes one resume, where :class:`WaitAny` takes
+    one per key.
+
+    :Parameters:
+      - `keys`: Keys to wait for
+      - `max_results`: Optional maximum number of pairs to return
+    """
+    def __init__(self, keys, max_results=None):
+        super(WaitSome, self).__init__(keys)
+        self.max_results = max_results
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        results = []
         for key in self.keys:
             if self.runner.is_ready(key):
-                return key, self.runner.pop_result(key)
+                results.append((key, self.runner.pop_result(key)))
+                if len(results) == self.max_results:
+                    break
+
+        if not results:
+            raise Exception("no results found")
+
+        if metrics.collector is not None:
+            metrics.finished(self, winner=[key for key, _ in results])
+        return results
+
+
+class WaitN(WaitAny):
+    """Wait for several keys, and continue when `n` of them are complete.
+
+    Returns a list of ``(key, result)`` pairs for the first `n` keys to
+    complete, in the order completed. For example, read from three replicas
+    and take the first two replies, giving up on the third::
+
+        replies = yield yieldpoints.WithTimeout(
+            timedelta(seconds=1),
+            yieldpoints.WaitN(2, ['a', 'b', 'c'], cancel_rest=True))
+
+    :Parameters:
+      - `n`: How many keys to wait for
+      - `keys`: Keys to wait for
+      - `cancel_rest`: If True, cancel the other keys once `n` are complete,
+        as with :class:`Cancel`
+    """
+    def __init__(self, n, keys, cancel_rest=False):
+        super(WaitN, self).__init__(keys)
+        if n > len(keys):
+            raise ValueError("can't wait for %d of %d keys" % (n, len(keys)))
+        self.n = n
+        self.cancel_rest = cancel_rest
+        self.ready_keys = []
+
+    def start(self, runner):
+        super(WaitN, self).start(runner)
+        results = _result_dict(runner)
+        for key in self.keys:
+            if runner.is_ready(key):
+                self.ready_keys.append(key)
+            else:
+                results.watchers[key] = self
+
+        completed = results.completed
+        self.ready_keys.sort(key=lambda key: completed.get(key, -1))
+
+    def key_completed(self, key):
+        self.ready_keys.append(key)
+
+    def key_canceled(self, key):
+        pass
+
+    def is_ready(self):
+        return len(self.ready_keys) >= self.n
+
+    def get_result(self):
+        if not self.is_ready():
+            raise Exception("only %d of %d results found" % (
+                len(self.ready_keys), self.n))
+
+        if metrics.collector is not None:
+            metrics.ready(self)
+        winners = self.ready_keys[:self.n]
+        results = [(key, self.runner.pop_result(key)) for key in winners]
+        winners = set(winners)
+        watchers = self.runner.results.watchers
+        for key in self.keys:
+            if key not in winners:
+                if watchers.get(key) is self:
+                    del watchers[key]
+                if self.cancel_rest:
+                    cancel(self.runner, key)
+
+        if metrics.collector is not None:
+            metrics.finished(self, winner=[key for key, _ in results])
+        return results
+
+
+class AsCompleted(WaitAny):
+    """Wait for several keys, and get their results in the order completed.
+
+    Unlike :class:`WaitAny`, an ``AsCompleted`` is yielded repeatedly. Each
+    time it returns the next ``(key, result)`` pair, and it is true as long
+    as any of its keys have not been returned::
+
+        completed = yieldpoints.AsCompleted(keys)
+        while completed:
+            key, result = yield completed
+
+    Completions are recorded as they arrive rather than discovered by polling
+    every key, so draining n keys costs O(n) in total instead of O(n^2). A
+    key may be watched by only one ``AsCompleted`` at a time.
+    """
+    def __init__(self, keys):
+        super(AsCompleted, self).__init__(keys)
+        self.pending_keys = set(keys)
+        self.ready_keys = deque()
+        self.runner = None
+
+    def __len__(self):
+        return len(self.pending_keys)
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        if self.runner is runner:
+            return
+
+        self.runner = runner
+        results = _result_dict(runner)
+        for key in self.pending_keys:
+            if runner.is_ready(key):
+                self.ready_keys.append(key)
+            else:
+                results.watchers[key] = self
+
+    def key_completed(self, key):
+        self.ready_keys.append(key)
+
+    def key_canceled(self, key):
+        self.pending_keys.discard(key)
+
+    def is_ready(self):
+        return bool(self.ready_keys)
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        while self.ready_keys:
+            key = self.ready_keys.popleft()
+            if key in self.runner.pending_callbacks:
+                self.pending_keys.discard(key)
+                result = key, self.runner.pop_result(key)
+                if metrics.collector is not None:
+                    metrics.finished(self, winner=key)
+                return result
+
+            # Canceled after it completed.
+            self.pending_keys.discard(key)
+
         raise Exception("no results found")
 
 
@@ -54,36 +580,221 @@ class WithTimeout(gen.YieldPoint):
     """Wait for a YieldPoint or a timeout, whichever comes first.
 
     :Parameters:
-      - `deadline`: A timestamp or timedelta
+      - `deadline`: A timestamp, timedelta, or :class:`AdaptiveTimeout`, or
+        None to wait only for the current :class:`Deadline`
       - `yield_point`: A ``gen.YieldPoint`` or a key
       - `io_loop`: Optional custom ``IOLoop`` on which to run timeout
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule the timeout
+        on, instead of adding a timeout to the ``IOLoop``
+      - `cancel`: If True, cancel `yield_point`'s pending keys when it times
+        out, as with :class:`Cancel`
+
+    The timeout is removed once `yield_point` completes. Within
+    :func:`run_with_deadline`, if the :class:`Deadline` is sooner than
+    `deadline` it is used instead, and its timeout is shared rather than
+    adding another. ``inherited`` is set to that ``Deadline``.
+
+    A ``WithTimeout`` can be yielded again, to save allocating one for each
+    wait in a loop. With a timedelta, each wait gets a fresh timeout; use
+    :meth:`reset` to change the deadline::
+
+        wait = yieldpoints.WithTimeout(
+            timedelta(seconds=1), yieldpoints.WaitAny(pending))
+
+        while pending:
+            key, result = yield wait
+            pending.remove(key)
     """
-    def __init__(self, deadline, yield_point, io_loop=None):
+    def __init__(self, deadline, yield_point, io_loop=None, timer_wheel=None,
+                 cancel=False):
         self.deadline = deadline
         if isinstance(yield_point, gen.YieldPoint):
             self.yield_point = yield_point
+            self.key = None
         else:
-            # yield_point is actually a key, e.g. gen.Callback('key')
-            self.yield_point = gen.Wait(yield_point)
+            # yield_point is actually a key, e.g. gen.Callback('key'). Wait
+            # for it directly instead of allocating a gen.Wait.
+            self.yield_point = None
+            self.key = yield_point
         self.expired = False
         self.timeout = None
+        self.inherited = None
         self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.cancel = cancel
+        self.start_time = None
+
+    def reset(self, deadline):
+        """Set a new `deadline` for the next time this is yielded."""
+        self.deadline = deadline
 
     def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
         self.runner = runner
-        self.timeout = self.io_loop.add_timeout(self.deadline, self.expire)
-        self.yield_point.start(runner)
+        self.expired = False
+        self.timeout = self.inherited = self.start_time = None
+        deadline = self.deadline
+        if isinstance(deadline, AdaptiveTimeout):
+            self.start_time = self.io_loop.time()
+            deadline = self.start_time + deadline.timeout()
+
+        self.timeout = schedule_deadline(
+            deadline, self.expire, self.io_loop, self.timer_wheel)
+        if self.timeout is not None:
+            self.inherited = self.timeout.inherited
+
+        if self.yield_point is not None:
+            self.yield_point.start(runner)
 
     def is_ready(self):
-        return self.expired or self.yield_point.is_ready()
+        if self.expired:
+            return True
+        if self.yield_point is None:
+            return self.runner.is_ready(self.key)
+        return self.yield_point.is_ready()
 
     def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
         if self.expired:
             raise TimeoutException()
 
-        return self.yield_point.get_result()
+        cancel_deadline(self.timeout)
+        self.timeout = None
+
+        if self.yield_point is None:
+            result = self.runner.pop_result(self.key)
+        else:
+            result = self.yield_point.get_result()
+        if self.start_time is not None:
+            self.deadline.add(self.io_loop.time() - self.start_time)
+        if metrics.collector is not None:
+            if self.yield_point is None:
+                winner = self.key
+            else:
+                winner = getattr(self.yield_point, 'metrics_winner', None)
+            metrics.finished(self, winner=winner)
+        return result
+
+    def expire(self):
+        self.timeout = None
+        self.expired = True
+        if self.start_time is not None and self.inherited is None:
+            # Timed out by the adaptive timeout, not a sooner Deadline.
+            self.deadline.add(self.io_loop.time() - self.start_time)
+        if metrics.collector is not None:
+            metrics.finished(self, expired=True)
+        if self.cancel:
+            if self.yield_point is None:
+                keys = [self.key]
+            elif hasattr(self.yield_point, 'keys'):
+                keys = list(self.yield_point.keys)
+            else:
+                # gen.Wait, gen.Task, or similar.
+                keys = [getattr(self.yield_point, 'key', None)]
+
+            pending = self.runner.pending_callbacks
+            for key in keys:
+                if key in pending:
+                    cancel(self.runner, key)
+
+        self.runner.run()
+
+
+class Gather(gen.YieldPoint):
+    """Wait for several keys until all are complete or `deadline` passes, and
+    get the results that arrived in time.
+
+    Returns a dict of keys to results, and the set of keys that weren't
+    complete. Those keys are canceled, as with :class:`Cancel`, unless
+    `cancel` is False::
+
+        results, missing = yield yieldpoints.Gather(
+            shards, timedelta(seconds=0.2))
+
+    Completions are counted as they arrive, and the coroutine resumes once,
+    when the last key completes or at the deadline. Within
+    :func:`run_with_deadline`, the :class:`Deadline` is used if it's sooner.
+
+    :Parameters:
+      - `keys`: Keys to wait for
+      - `deadline`: Optional timestamp or timedelta
+      - `cancel`: Optional, whether to cancel keys that aren't complete at
+        the deadline, default True
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeout
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeout on
+    """
+    def __init__(self, keys, deadline=None, cancel=True, io_loop=None,
+                 timer_wheel=None):
+        self.keys = keys
+        self.deadline = deadline
+        self.cancel = cancel
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.completed = []
+        self.n_pending = 0
+        self.expired = False
+        self.timeout = None
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        self.runner = runner
+        results = _result_dict(runner)
+        for key in self.keys:
+            if runner.is_ready(key):
+                self.completed.append(key)
+            else:
+                results.watchers[key] = self
+                self.n_pending += 1
+
+        if not self.n_pending:
+            return
+
+        self.timeout = schedule_deadline(
+            self.deadline, self.expire, self.io_loop, self.timer_wheel)
+
+    def key_completed(self, key):
+        self.completed.append(key)
+        self.n_pending -= 1
+
+    def key_canceled(self, key):
+        self.n_pending -= 1
+
+    def is_ready(self):
+        return self.expired or not self.n_pending
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        runner = self.runner
+        cancel_deadline(self.timeout)
+        self.timeout = None
+
+        results = {}
+        for key in self.completed:
+            if key in runner.pending_callbacks:
+                results[key] = runner.pop_result(key)
+
+        missing = set()
+        if self.n_pending:
+            watchers = runner.results.watchers
+            for key in self.keys:
+                if key not in results and key in runner.pending_callbacks:
+                    missing.add(key)
+                    if watchers.get(key) is self:
+                        del watchers[key]
+                    if self.cancel:
+                        cancel(runner, key)
+
+        if metrics.collector is not None:
+            metrics.finished(self, expired=self.expired, winner=[
+                key for key in self.completed if key in results])
+        return results, missing
 
     def expire(self):
+        self.timeout = None
         self.expired = True
         self.runner.run()
 
@@ -104,6 +815,27 @@ class Cancel(gen.YieldPoint):
         return None
 
 
+class CancelGroup(gen.YieldPoint):
+    """Cancel the pending keys in a group, registered with :class:`Callback`
+
+    Its cost is proportional to the size of the group, and it doesn't copy
+    the group or the coroutine's pending keys.
+    """
+    def __init__(self, group):
+        self.group = group
+
+    def start(self, runner):
+        keys = _result_dict(runner).groups.pop(self.group, ())
+        for key in keys:
+            cancel(runner, key)
+
+    def is_ready(self):
+        return True
+
+    def get_result(self):
+        return None
+
+
 class CancelAll(gen.YieldPoint):
     """Cancel all keys for which the current coroutine has registered callbacks
     """
@@ -117,3 +849,1388 @@ class CancelAll(gen.YieldPoint):
 
     def get_result(self):
         return None
+
+
+class LatencyWindow(object):
+    """Track a percentile of recent latencies, for use as a :class:`Hedge`
+    delay.
+
+    :Parameters:
+      - `percentile`: Optional percentile to report, default 95
+      - `size`: Optional number of recent latencies to keep, default 1000
+      - `default`: Optional value to report before any latency is added
+    """
+    def __init__(self, percentile=95, size=1000, default=None):
+        self.percentile = percentile
+        self.size = size
+        self.default = default
+        self.recent = deque()
+        self.sorted = []
+
+    def __len__(self):
+        return len(self.recent)
+
+    def add(self, latency):
+        """Record a latency in seconds, forgetting the oldest if full."""
+        if len(self.recent) == self.size:
+            oldest = self.recent.popleft()
+            del self.sorted[bisect_left(self.sorted, oldest)]
+
+        self.recent.append(latency)
+        insort(self.sorted, latency)
+
+    def value(self, percentile=None):
+        """The `percentile` of recent latencies, or `default` if none."""
+        if not self.sorted:
+            return self.default
+
+        if percentile is None:
+            percentile = self.percentile
+
+        index = int(math.ceil(percentile / 100.0 * len(self.sorted))) - 1
+        return self.sorted[max(0, index)]
+
+
+class AdaptiveTimeout(LatencyWindow):
+    """A timeout learned from recent latencies, for use as a
+    :class:`WithTimeout` deadline.
+
+    The timeout is `factor` times a percentile of recent latencies, clamped
+    between `min_timeout` and `max_timeout`. Each ``WithTimeout`` with an
+    ``AdaptiveTimeout`` adds the time it waited; a wait that times out
+    counts as taking its whole timeout, so a timeout that's too tight grows.
+    Keep an estimate for each kind of operation with :meth:`label`::
+
+        timeouts = yieldpoints.AdaptiveTimeout(
+            percentile=99, factor=2, min_timeout=0.05, max_timeout=5)
+
+        response = yield yieldpoints.WithTimeout(
+            timeouts.label('search'), 'search')
+
+    Memory for each label is bounded by `size`.
+
+    :Parameters:
+      - `percentile`: Optional percentile of latencies, default 99
+      - `factor`: Optional multiple of the percentile, default 2
+      - `min_timeout`: Optional shortest timeout in seconds, default 0
+      - `max_timeout`: Optional longest timeout in seconds
+      - `initial`: Optional timeout before any latency is added, default 1
+      - `size`: Optional number of recent latencies to keep, default 1000
+    """
+    def __init__(self, percentile=99, factor=2, min_timeout=0,
+                 max_timeout=None, initial=1, size=1000):
+        super(AdaptiveTimeout, self).__init__(percentile, size)
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial = initial
+        self.labels = {}
+
+    def timeout(self):
+        """The timeout in seconds."""
+        latency = self.value()
+        if latency is None:
+            return self.initial
+
+        timeout = max(self.min_timeout, latency * self.factor)
+        if self.max_timeout is not None:
+            timeout = min(self.max_timeout, timeout)
+        return timeout
+
+    def label(self, name):
+        """The ``AdaptiveTimeout`` for `name`, with the same settings."""
+        adaptive = self.labels.get(name)
+        if adaptive is None:
+            adaptive = self.labels[name] = AdaptiveTimeout(
+                self.percentile, self.factor, self.min_timeout,
+                self.max_timeout, self.initial, self.size)
+        return adaptive
+
+
+class Hedge(gen.YieldPoint):
+    """Run an asynchronous operation, and start backups if it's slow.
+
+    Like ``gen.Task``, calls `func` with a ``callback`` keyword argument. If
+    the call hasn't completed after `delay` seconds, calls `func` again
+    `backups` times. The first result wins, and the other calls' keys are
+    canceled. The index of the winning call, 0 for the first, is stored in
+    ``winner``.
+
+    Pass a :class:`LatencyWindow` as `delay` to hedge after a percentile
+    of recent latencies; each winning call's latency is added to it::
+
+        latencies = yieldpoints.LatencyWindow(percentile=95, default=0.1)
+
+        response = yield yieldpoints.Hedge(
+            partial(client.fetch, url), latencies)
+
+    :Parameters:
+      - `func`: A function that takes a ``callback`` argument
+      - `delay`: Seconds to wait before starting backups, or a
+        :class:`LatencyWindow`. If None, backups are never started.
+      - `backups`: Optional number of backup calls, default 1
+      - `io_loop`: Optional custom ``IOLoop`` on which to run the delay
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule the delay on
+    """
+    def __init__(self, func, delay, backups=1, io_loop=None, timer_wheel=None):
+        self.func = func
+        self.delay = delay
+        self.backups = backups
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.keys = []
+        self.start_times = {}
+        self.wait_any = WaitAny(self.keys)
+        self.timeout = None
+        self.winner = None
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        self.runner = runner
+        # Not wait_any.start(), so metrics count this as one Hedge only.
+        self.wait_any.runner = runner
+        self._call()
+        if isinstance(self.delay, LatencyWindow):
+            delay = self.delay.value()
+        else:
+            delay = self.delay
+
+        if delay is not None and self.backups:
+            self.timeout = schedule_deadline(
+                self.io_loop.time() + delay, self.hedge, self.io_loop,
+                self.timer_wheel, inherit=False)
+
+    def is_ready(self):
+        return self.wait_any.is_ready()
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        key, result = self.wait_any.get_result()
+        self.winner = self.keys.index(key)
+        cancel_deadline(self.timeout)
+        self.timeout = None
+
+        for other in self.keys:
+            if other is not key:
+                cancel(self.runner, other)
+
+        if isinstance(self.delay, LatencyWindow):
+            self.delay.add(self.io_loop.time() - self.start_times[key])
+
+        if metrics.collector is not None:
+            metrics.finished(self, winner=key)
+        return result
+
+    def hedge(self):
+        self.timeout = None
+        # Don't start backups if the coroutine gave up, e.g. after a timeout.
+        if self.keys[0] in self.runner.pending_callbacks:
+            for _ in range(self.backups):
+                self._call()
+
+    def _call(self):
+        key = object()
+        self.runner.register_callback(key)
+        self.keys.append(key)
+        self.start_times[key] = self.io_loop.time()
+        self.func(callback=self.runner.result_callback(key))
+
+
+def _is_exception(result):
+    return isinstance(result, Exception)
+
+
+class Retry(gen.YieldPoint):
+    """Run an asynchronous operation, and retry it with backoff if it fails.
+
+    Like ``gen.Task``, calls `func` with a ``callback`` keyword argument. An
+    attempt fails if its result is an error, or if it takes longer than
+    `timeout`; then the attempt's key is canceled, and after a random delay
+    of up to ``backoff * 2 ** n`` seconds `func` is called again::
+
+        response = yield yieldpoints.Retry(
+            partial(client.fetch, url), attempts=5,
+            timeout=timedelta(seconds=1), deadline=timedelta(seconds=3),
+            is_error=lambda response: response.error)
+
+    Retrying stops after `attempts` calls, or if `deadline` would pass
+    before the next attempt starts. Then the last failed result is returned,
+    or if the last attempt timed out, :class:`TimeoutException` is raised.
+    At `deadline` the attempt in progress is canceled and
+    :class:`TimeoutException` is raised. Within :func:`run_with_deadline`,
+    the :class:`Deadline` is used if it's sooner. The number of calls made is
+    stored in ``attempt``.
+
+    A ``Retry`` always has one pending key, for the attempt in progress or
+    the next one. Canceling it, with :class:`CancelAll` or a
+    :class:`WithTimeout` with ``cancel=True``, stops the ``Retry``.
+
+    :Parameters:
+      - `func`: A function that takes a ``callback`` argument
+      - `attempts`: Optional maximum number of calls, default 3
+      - `timeout`: Optional seconds or timedelta to wait for each attempt
+      - `deadline`: Optional timestamp or timedelta to stop retrying
+      - `backoff`: Optional seconds of the first retry's maximum delay,
+        doubled for each retry, default 0.1
+      - `max_backoff`: Optional largest delay in seconds, default 10
+      - `is_error`: Optional function that takes a result and returns True
+        if it's a failure. By default, an ``Exception`` is a failure.
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeouts on
+    """
+    def __init__(self, func, attempts=3, timeout=None, deadline=None,
+                 backoff=0.1, max_backoff=10, is_error=None, io_loop=None,
+                 timer_wheel=None):
+        self.func = func
+        self.attempts = attempts
+        if isinstance(timeout, timedelta):
+            timeout = timedelta_to_seconds(timeout)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.is_error = is_error or _is_exception
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.attempt = 0
+        self.key = None
+        self.attempt_timeout = None
+        self.deadline_timeout = None
+        self.finished = False
+        self.result = None
+        self.timed_out = False
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        self.runner = runner
+        self.deadline_timeout = schedule_deadline(
+            self.deadline, self.expire, self.io_loop, self.timer_wheel)
+        if self.deadline_timeout is not None:
+            self.deadline = self.deadline_timeout.deadline
+
+        if not self.finished:
+            self._call()
+
+    def is_ready(self):
+        return self.finished
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        if self.timed_out:
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            raise TimeoutException()
+
+        if metrics.collector is not None:
+            metrics.finished(self)
+        return self.result
+
+    def key_completed(self, key):
+        result = self.runner.pop_result(key)
+        self.key = None
+        cancel_deadline(self.attempt_timeout)
+        self.attempt_timeout = None
+
+        # The runner runs after the result is stored, no need to run it here.
+        if self.is_error(result):
+            self._failed(result, False)
+        else:
+            self._finish(result, False)
+
+    def key_canceled(self, key):
+        # The coroutine canceled this attempt or the backoff, e.g. with
+        # CancelAll. Stop retrying.
+        self.key = None
+        self._finish(None, True)
+
+    def expire_attempt(self):
+        self.attempt_timeout = None
+        self._cancel_key()
+        self._failed(None, True)
+        self.runner.run()
+
+    def expire(self):
+        self.deadline_timeout = None
+        if not self.finished:
+            self._cancel_key()
+            self._finish(None, True)
+            self.runner.run()
+
+    def _failed(self, result, timed_out):
+        if self.attempt < self.attempts:
+            delay = min(self.max_backoff,
+                        self.backoff * 2 ** (self.attempt - 1))
+            retry_at = self.io_loop.time() + random.uniform(0, delay)
+            if self.deadline is None or retry_at < self.deadline:
+                # Register the next attempt's key now, so the coroutine can
+                # cancel the Retry during the backoff, e.g. with CancelAll.
+                self._register()
+                self.attempt_timeout = schedule_deadline(
+                    retry_at, self._retry, self.io_loop, self.timer_wheel,
+                    inherit=False)
+                return
+
+        self._finish(result, timed_out)
+
+    def _finish(self, result, timed_out):
+        self.finished = True
+        self.result = result
+        self.timed_out = timed_out
+        cancel_deadline(self.attempt_timeout)
+        cancel_deadline(self.deadline_timeout)
+        self.attempt_timeout = self.deadline_timeout = None
+
+    def _retry(self):
+        self.attempt_timeout = None
+        self._call()
+
+    def _call(self):
+        runner = self.runner
+        self.attempt += 1
+        if self.key is None:
+            self._register()
+        key = self.key
+        if self.timeout is not None:
+            self.attempt_timeout = schedule_deadline(
+                self.io_loop.time() + self.timeout, self.expire_attempt,
+                self.io_loop, self.timer_wheel, inherit=False)
+
+        self.func(callback=runner.result_callback(key))
+
+    def _register(self):
+        self.key = key = object()
+        self.runner.register_callback(key)
+        _result_dict(self.runner).watchers[key] = self
+
+    def _cancel_key(self):
+        key, self.key = self.key, None
+        if key is not None and key in self.runner.pending_callbacks:
+            del self.runner.results.watchers[key]
+            cancel(self.runner, key)
+
+
+_no_item = object()
+
+
+class Pool(gen.YieldPoint):
+    """Run an asynchronous operation on many items, at most `concurrency` at
+    a time, and get the results in the order completed.
+
+    Calls ``func(item, callback=...)`` for each item. Like
+    :class:`AsCompleted`, a ``Pool`` is yielded repeatedly: each time it
+    returns the next ``(item, result)`` pair and starts the next item, and
+    it is true as long as any items haven't been returned. `items` can be an
+    iterator; it's consumed as items are started::
+
+        pool = yieldpoints.Pool(
+            client.fetch, urls, concurrency=100,
+            timeout=timedelta(seconds=5), deadline=time.time() + 60)
+
+        while pool:
+            try:
+                url, response = yield pool
+            except yieldpoints.TimeoutException as e:
+                if not e.args:
+                    break # Deadline: the rest of the urls are abandoned.
+                url = e.args[0]
+
+    If an item takes longer than `timeout` its key is canceled, and yielding
+    the ``Pool`` raises a :class:`TimeoutException` with the item as its
+    argument. At `deadline`, all the items in progress are canceled, the rest
+    are dropped, and the ``Pool`` raises a :class:`TimeoutException` with no
+    arguments.
+    Within :func:`run_with_deadline`, the :class:`Deadline` is used if it's
+    sooner.
+
+    :Parameters:
+      - `func`: A function that takes an item and a ``callback`` argument
+      - `items`: Items to pass to `func`
+      - `concurrency`: How many items to run at once
+      - `timeout`: Optional seconds or timedelta to wait for each item
+      - `deadline`: Optional timestamp or timedelta to stop running items
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeouts on
+    """
+    def __init__(self, func, items, concurrency, timeout=None, deadline=None,
+                 io_loop=None, timer_wheel=None):
+        self.func = func
+        self.items = iter(items)
+        self.concurrency = concurrency
+        if isinstance(timeout, timedelta):
+            timeout = timedelta_to_seconds(timeout)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.runner = None
+        self.in_flight = {}
+        self.ready = deque()
+        self.deadline_timeout = None
+        self.expired = False
+        self.next_item = _no_item
+        self._advance()
+
+    def __nonzero__(self):
+        return bool(self.in_flight or self.ready or self.expired
+                    or self.next_item is not _no_item)
+
+    __bool__ = __nonzero__
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        if self.runner is runner:
+            return
+
+        self.runner = runner
+        self.deadline_timeout = schedule_deadline(
+            self.deadline, self.expire, self.io_loop, self.timer_wheel)
+
+        self._fill()
+
+    def is_ready(self):
+        return self.expired or bool(self.ready)
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        if self.expired:
+            self.expired = False
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            raise TimeoutException()
+
+        key, item, timed_out = self.ready.popleft()
+        if timed_out:
+            self._fill()
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            raise TimeoutException(item)
+
+        item, timeout = self.in_flight.pop(key)
+        cancel_deadline(timeout)
+        result = self.runner.pop_result(key)
+        self._fill()
+        if not self:
+            cancel_deadline(self.deadline_timeout)
+            self.deadline_timeout = None
+
+        if metrics.collector is not None:
+            metrics.finished(self, winner=item)
+        return item, result
+
+    def key_completed(self, key):
+        self.ready.append((key, self.in_flight[key][0], False))
+
+    def key_canceled(self, key):
+        item, timeout = self.in_flight.pop(key)
+        cancel_deadline(timeout)
+
+    def expire_item(self, key):
+        if key not in self.in_flight or key in self.runner.results:
+            # Completed first.
+            return
+
+        item, _ = self.in_flight.pop(key)
+        del self.runner.results.watchers[key]
+        cancel(self.runner, key)
+        self.ready.append((key, item, True))
+        self.runner.run()
+
+    def expire(self):
+        self.deadline_timeout = None
+        self.expired = True
+        self.next_item = _no_item
+        self.ready.clear()
+        watchers = self.runner.results.watchers
+        for key, (item, timeout) in self.in_flight.items():
+            cancel_deadline(timeout)
+            watchers.pop(key, None)
+            cancel(self.runner, key)
+
+        self.in_flight.clear()
+        self.runner.run()
+
+    def _advance(self):
+        try:
+            self.next_item = next(self.items)
+        except StopIteration:
+            self.next_item = _no_item
+
+    def _fill(self):
+        while (len(self.in_flight) < self.concurrency
+               and self.next_item is not _no_item):
+            item = self.next_item
+            self._advance()
+            self._start_item(item)
+
+    def _start_item(self, item):
+        runner = self.runner
+        key = object()
+        runner.register_callback(key)
+        timeout = None
+        if self.timeout is not None:
+            timeout = schedule_deadline(
+                self.io_loop.time() + self.timeout,
+                partial(self.expire_item, key), self.io_loop,
+                self.timer_wheel, inherit=False)
+
+        self.in_flight[key] = (item, timeout)
+        _result_dict(runner).watchers[key] = self
+        self.func(item, callback=runner.result_callback(key))
+
+
+class _LRUCache(object):
+    """A dict of at most `max_size` entries that evicts the least recently
+    used.
+
+    Each access appends to ``order``; stale records are skipped on eviction
+    and dropped when ``order`` grows to twice the number of entries.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = {}
+        self.order = deque()
+        self.stamp = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        self._touch(key, entry)
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, value]
+        else:
+            entry[1] = value
+
+        self._touch(key, entry)
+        while len(self.entries) > self.max_size:
+            old_key, stamp = self.order.popleft()
+            old_entry = self.entries.get(old_key)
+            if old_entry is not None and old_entry[0] == stamp:
+                del self.entries[old_key]
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def _touch(self, key, entry):
+        self.stamp += 1
+        entry[0] = self.stamp
+        self.order.append((key, self.stamp))
+        if len(self.order) > 2 * len(self.entries) + 16:
+            records = [(stamp, k) for k, (stamp, _) in self.entries.items()]
+            records.sort()
+            self.order = deque((k, stamp) for stamp, k in records)
+
+
+class _Join(gen.YieldPoint):
+    def __init__(self, flight, name, key):
+        self.flight = flight
+        self.name = name
+        self.key = key
+
+    def start(self, runner):
+        runner.register_callback(self.key)
+        results = _result_dict(runner)
+        handle = self.flight.join(self.name, runner.result_callback(self.key))
+        if handle is not None and self.key not in results:
+            results.abort_hooks[self.key] = partial(
+                self.flight.leave, self.name, handle)
+
+    def is_ready(self):
+        return True
+
+    def get_result(self):
+        return None
+
+
+class SingleFlight(object):
+    """Share one call of an asynchronous operation among all the coroutines
+    that want its result at once.
+
+    Calls ``func(name, callback=...)`` for a `name` only if no call for that
+    name is in progress; otherwise the caller joins the call in progress.
+    Like ``gen.Callback``, yielding :meth:`call` registers a key and
+    continues at once, and the key gets the shared result::
+
+        users = yieldpoints.SingleFlight(fetch_user, ttl=1)
+
+        @gen.coroutine
+        def get(self, user_id):
+            yield users.call(user_id, 'user')
+            user = yield yieldpoints.WithTimeout(
+                timedelta(seconds=1), 'user', cancel=True)
+
+    Canceling a key, e.g. with :class:`Cancel` or a
+    :class:`WithTimeout` with ``cancel=True``, only detaches that caller:
+    the call continues for the others, and its result is still cached. Once
+    every caller has detached, the call is abandoned, so a call that never
+    finishes doesn't block that name, and the next caller starts a new one.
+
+    If `func` raises, the exception is the result for the callers waiting.
+
+    If `ttl` is set, results are cached for `ttl` seconds, and calls within
+    that time get the cached result without calling `func`. At most
+    `max_size` results are cached, and the least recently used are evicted.
+    Results that are exceptions aren't cached.
+
+    `func` is called outside the caller's ``stack_context``, so a
+    request-scoped :class:`Deadline` or exception handler doesn't apply to
+    the shared call.
+
+    :Parameters:
+      - `func`: A function that takes a name and a ``callback`` argument
+      - `ttl`: Optional seconds or timedelta to cache results
+      - `max_size`: Optional maximum number of cached results, default 1000
+      - `io_loop`: Optional custom ``IOLoop`` whose clock times the cache
+    """
+    def __init__(self, func, ttl=None, max_size=1000, io_loop=None):
+        self.func = func
+        if isinstance(ttl, timedelta):
+            ttl = timedelta_to_seconds(ttl)
+        self.ttl = ttl
+        self.io_loop = io_loop or IOLoop.instance()
+        self.flights = {}
+        self.cache = _LRUCache(max_size)
+        self.calls = 0
+        self.hits = 0
+
+    def call(self, name, key):
+        """A YieldPoint that registers `key` for the result for `name`."""
+        return _Join(self, name, key)
+
+    def join(self, name, callback):
+        """Run `callback` with the result for `name`.
+
+        Returns a handle for :meth:`leave`, or None if `callback` was run
+        with a cached result.
+        """
+        if self.ttl is not None:
+            cached = self.cache.get(name)
+            if cached is not None:
+                expires, result = cached
+                if self.io_loop.time() < expires:
+                    self.hits += 1
+                    callback(result)
+                    return None
+
+                self.cache.pop(name)
+
+        waiters = self.flights.get(name)
+        handle = object()
+        if waiters is None:
+            waiters = self.flights[name] = {handle: callback}
+            self.calls += 1
+            try:
+                with stack_context.NullContext():
+                    self.func(
+                        name, callback=partial(self._done, name, waiters))
+            except Exception as e:
+                self._done(name, waiters, e)
+        else:
+            waiters[handle] = callback
+
+        return handle
+
+    def leave(self, name, handle):
+        """Stop waiting for the result for `name`. The call continues for
+        the other callers, or is abandoned if there are none.
+        """
+        waiters = self.flights.get(name)
+        if waiters is not None:
+            waiters.pop(handle, None)
+            if not waiters:
+                del self.flights[name]
+
+    def _done(self, name, waiters, result=None):
+        # An abandoned call's result isn't cached or shared.
+        if self.flights.get(name) is waiters:
+            del self.flights[name]
+            if self.ttl is not None and not isinstance(result, Exception):
+                self.cache[name] = (self.io_loop.time() + self.ttl, result)
+
+        callbacks = list(waiters.values())
+        waiters.clear()
+        for callback in callbacks:
+            callback(result)
+
+
+class Select(gen.YieldPoint):
+    """Wait for the first of several :class:`Get` and :class:`Put` cases.
+
+    Like Go's ``select``. Returns ``(case, result)`` for the case that
+    completed, where the result of a ``Get`` is the item and the result of a
+    ``Put`` is None. If several cases can complete immediately, the first
+    in `cases` is chosen::
+
+        case, item = yield yieldpoints.Select(
+            [yieldpoints.Get(urgent), yieldpoints.Get(normal)],
+            deadline=timedelta(seconds=1))
+
+    Once one case completes the others are withdrawn, so no other item is
+    taken or put. At `deadline` every case is withdrawn and
+    :class:`TimeoutException` is raised. Use `deadline` rather than
+    wrapping a ``Select`` in :class:`WithTimeout`, which can't withdraw the
+    cases. Within :func:`run_with_deadline`, the :class:`Deadline` is used
+    if it's sooner.
+
+    :Parameters:
+      - `cases`: :class:`Get` and :class:`Put` instances
+      - `deadline`: Optional timestamp or timedelta
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeout
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeout on
+    """
+    def __init__(self, cases, deadline=None, io_loop=None, timer_wheel=None):
+        self.cases = list(cases)
+        self.deadline = deadline
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.active = False
+        self.result = None
+        self.expired = False
+        self.timeout = None
+        self.wake = None
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        self.runner = runner
+        for case in self.cases:
+            try:
+                self.result = case, case.now()
+                return
+            except (QueueEmpty, QueueFull):
+                pass
+
+        self.active = True
+        self.wake = stack_context.wrap(runner.run)
+        for case in self.cases:
+            case.register(self)
+
+        self.timeout = schedule_deadline(
+            self.deadline, self.expire, self.io_loop, self.timer_wheel)
+
+    def is_ready(self):
+        return self.result is not None or self.expired
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        if self.expired:
+            raise TimeoutException()
+
+        if metrics.collector is not None:
+            metrics.finished(self)
+        return self.result
+
+    def finish(self, case, result):
+        """Called by a :class:`Queue` when `case` completes."""
+        self._withdraw(case)
+        self.result = case, result
+        # Like a gen.Callback, resume the coroutine now, in its own
+        # stack_context.
+        self.wake()
+
+    def expire(self):
+        self.timeout = None
+        if self.active:
+            self._withdraw(None)
+            self.expired = True
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            self.runner.run()
+
+    def _withdraw(self, completed):
+        self.active = False
+        for case in self.cases:
+            if case is not completed:
+                case.withdraw()
+
+        cancel_deadline(self.timeout)
+        self.timeout = None
+
+
+class _Case(gen.YieldPoint):
+    # Yielded alone, a case is a Select of one.
+    def start(self, runner):
+        self.select = Select([self])
+        self.select.start(runner)
+
+    def is_ready(self):
+        return self.select.is_ready()
+
+    def get_result(self):
+        return self.select.get_result()[1]
+
+
+class Get(_Case):
+    """Get an item from a :class:`Queue`, waiting until one is available.
+
+    Yield a ``Get`` to wait for an item, or pass it to :class:`Select`.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def now(self):
+        return self.queue.get_nowait()
+
+    def register(self, select):
+        self.queue.getters.append((select, self))
+
+    def withdraw(self):
+        self.queue._withdraw_getter()
+
+
+class Put(_Case):
+    """Put an item in a :class:`Queue`, waiting until it isn't full.
+
+    Yield a ``Put`` to wait for room, or pass it to :class:`Select`.
+    """
+    def __init__(self, queue, item):
+        self.queue = queue
+        self.item = item
+
+    def now(self):
+        return self.queue.put_nowait(self.item)
+
+    def register(self, select):
+        self.queue.putters.append((select, self))
+
+    def withdraw(self):
+        self.queue._withdraw_putter()
+
+
+class _BreakerCall(gen.YieldPoint):
+    def __init__(self, breaker, func, timeout, is_error):
+        self.breaker = breaker
+        self.func = func
+        if isinstance(timeout, timedelta):
+            timeout = timedelta_to_seconds(timeout)
+        self.timeout = timeout
+        self.is_error = is_error or _is_exception
+        self.rejected = False
+        self.probe = False
+        self.finished = False
+        self.timed_out = False
+        self.result = None
+        self.handle = None
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        breaker = self.breaker
+        allowed = breaker.allow()
+        if not allowed:
+            self.rejected = True
+            return
+
+        self.runner = runner
+        self.probe = allowed is _PROBE
+        key = self.key = object()
+        runner.register_callback(key)
+        _result_dict(runner).watchers[key] = self
+        if self.timeout is not None:
+            self.handle = schedule_deadline(
+                breaker.io_loop.time() + self.timeout, self.expire,
+                breaker.io_loop, breaker.timer_wheel, inherit=False)
+
+        try:
+            self.func(callback=runner.result_callback(key))
+        except Exception:
+            if not self.finished:
+                # Count it as a failed call, and release a probe.
+                cancel_deadline(self.handle)
+                self.handle = None
+                del runner.results.watchers[key]
+                cancel(runner, key)
+                breaker.record(False, self.probe)
+            raise
+
+    def is_ready(self):
+        return self.rejected or self.finished
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+        if self.rejected:
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            raise CircuitOpenError()
+
+        if self.timed_out:
+            if metrics.collector is not None:
+                metrics.finished(self, expired=True)
+            raise TimeoutException()
+
+        if metrics.collector is not None:
+            metrics.finished(self)
+        return self.result
+
+    def key_completed(self, key):
+        self.result = self.runner.pop_result(key)
+        self.finished = True
+        cancel_deadline(self.handle)
+        self.handle = None
+        self.breaker.record(not self.is_error(self.result), self.probe)
+
+    def key_canceled(self, key):
+        # The coroutine gave up, e.g. with CancelAll. Not a failure.
+        cancel_deadline(self.handle)
+        self.handle = None
+        if self.probe:
+            self.breaker.probes_in_flight -= 1
+
+    def expire(self):
+        self.handle = None
+        if self.key in self.runner.pending_callbacks:
+            del self.runner.results.watchers[self.key]
+            cancel(self.runner, self.key)
+            self.finished = self.timed_out = True
+            self.breaker.record(False, self.probe)
+            self.runner.run()
+
+
+_PROBE = object()
+
+
+class CircuitBreaker(object):
+    """Fail fast while an operation is failing, instead of waiting for it.
+
+    Tracks whether the last `size` calls made with :meth:`call` succeeded. A
+    call fails if its result is an error or it takes longer than its
+    timeout. When at least `min_calls` are tracked and the fraction that
+    failed reaches `threshold`, the circuit opens: for `reset_timeout`
+    seconds, yielding a call raises :class:`CircuitOpenError` at once,
+    without calling the operation, registering a key, or adding a timeout.
+
+    Then the circuit is half-open, and up to `probes` calls at a time are
+    let through. If a probe succeeds the circuit closes, and if it fails
+    the circuit opens again::
+
+        breaker = yieldpoints.CircuitBreaker(threshold=0.5, reset_timeout=5)
+
+        try:
+            response = yield breaker.call(
+                partial(client.fetch, url), timeout=1,
+                is_error=lambda response: response.error)
+        except (yieldpoints.CircuitOpenError, yieldpoints.TimeoutException):
+            response = cached_response
+
+    The state, ``'closed'``, ``'open'`` or ``'half_open'``, is stored in
+    ``state``, and the number of times the circuit has opened in ``trips``.
+
+    :Parameters:
+      - `threshold`: Optional fraction of failed calls that opens the
+        circuit, default 0.5
+      - `size`: Optional number of recent calls to track, default 20
+      - `min_calls`: Optional number of calls to track before the circuit
+        can open, default 10
+      - `reset_timeout`: Optional seconds the circuit stays open, default 10
+      - `probes`: Optional number of calls at once while half-open,
+        default 1
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeouts on
+    """
+    def __init__(self, threshold=0.5, size=20, min_calls=10, reset_timeout=10,
+                 probes=1, io_loop=None, timer_wheel=None):
+        self.threshold = threshold
+        self.size = size
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.state = 'closed'
+        self.outcomes = deque()
+        self.failures = 0
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self.trips = 0
+
+    def call(self, func, timeout=None, is_error=None):
+        """A YieldPoint that calls `func`, unless the circuit is open.
+
+        Like ``gen.Task``, calls `func` with a ``callback`` keyword argument,
+        and returns its result. Raises :class:`TimeoutException` if `func`
+        takes longer than `timeout`, or :class:`CircuitOpenError`.
+
+        :Parameters:
+          - `func`: A function that takes a ``callback`` argument
+          - `timeout`: Optional seconds or timedelta to wait
+          - `is_error`: Optional function that takes a result and returns
+            True if it's a failure. By default, an ``Exception`` is a
+            failure.
+        """
+        return _BreakerCall(self, func, timeout, is_error)
+
+    def allow(self):
+        """Whether to start a call now. Returns a true value if so."""
+        if self.state == 'open':
+            if self.io_loop.time() < self.opened_at + self.reset_timeout:
+                return False
+            self.state = 'half_open'
+            self.probes_in_flight = 0
+
+        if self.state == 'half_open':
+            if self.probes_in_flight >= self.probes:
+                return False
+            self.probes_in_flight += 1
+            return _PROBE
+
+        return True
+
+    def record(self, success, probe=False):
+        """Track whether a call succeeded."""
+        if probe:
+            self.probes_in_flight -= 1
+            if self.state != 'half_open':
+                return
+            if success:
+                self.state = 'closed'
+            else:
+                self._trip()
+            return
+
+        if self.state != 'closed':
+            # Started before the circuit opened.
+            return
+
+        self.outcomes.append(success)
+        if not success:
+            self.failures += 1
+        if len(self.outcomes) > self.size:
+            if not self.outcomes.popleft():
+                self.failures -= 1
+
+        if (len(self.outcomes) >= self.min_calls
+                and self.failures >= self.threshold * len(self.outcomes)):
+            self._trip()
+
+    def _trip(self):
+        self.state = 'open'
+        self.opened_at = self.io_loop.time()
+        self.outcomes.clear()
+        self.failures = 0
+        self.trips += 1
+
+
+class _Drain(gen.YieldPoint):
+    def __init__(self, writer):
+        self.writer = writer
+        self.waiting = False
+
+    def start(self, runner):
+        self.waiting = not self.is_ready()
+        if self.waiting:
+            if metrics.collector is not None:
+                metrics.started(self)
+            self.writer.waiters.append(stack_context.wrap(runner.run))
+
+    def is_ready(self):
+        writer = self.writer
+        return not writer.flushing or writer.buffered < writer.high_water
+
+    def get_result(self):
+        if self.waiting and metrics.collector is not None:
+            metrics.ready(self)
+            metrics.finished(self)
+        self.waiting = False
+
+
+class CoalescingWriter(object):
+    """Coalesce a streaming ``RequestHandler``'s output into few flushes.
+
+    Instead of flushing after each result, write each result with a
+    ``CoalescingWriter``. Output is flushed when `max_bytes` are buffered, or
+    `max_delay` seconds after the first unflushed write, so results that
+    arrive close together are sent with one write to the socket::
+
+        writer = yieldpoints.CoalescingWriter(self)
+        while pending:
+            key, response = yield yieldpoints.WaitAny(pending)
+            pending.remove(key)
+            yield writer.write(render(response))
+
+        writer.finish()
+
+    Only one flush is in flight at a time, and output written meanwhile is
+    flushed when it completes. Yielding the return value of :meth:`write`
+    waits while a flush is in flight and `high_water` bytes are buffered
+    behind it, so a slow client slows the handler instead of filling its
+    memory. Otherwise the yield doesn't wait.
+
+    Call :meth:`finish` instead of the handler's ``finish``, so no flush is
+    scheduled after the response ends.
+
+    :Parameters:
+      - `handler`: A ``RequestHandler``
+      - `max_bytes`: Optional bytes to buffer before flushing, default 65536
+      - `max_delay`: Optional seconds to buffer before flushing, default
+        0.01
+      - `high_water`: Optional bytes buffered during a flush before
+        :meth:`write` waits, default four times `max_bytes`
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeouts on
+    """
+    def __init__(self, handler, max_bytes=65536, max_delay=0.01,
+                 high_water=None, io_loop=None, timer_wheel=None):
+        self.handler = handler
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        if high_water is None:
+            high_water = 4 * max_bytes
+        self.high_water = high_water
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.buffered = 0
+        self.flushing = False
+        self.finished = False
+        self.timeout = None
+        self.waiters = []
+        self.flushes = 0
+        self.drain = _Drain(self)
+
+    def write(self, chunk):
+        """Write `chunk` with the handler's ``write``.
+
+        Returns a YieldPoint that waits until the buffered output is below
+        `high_water`, or a flush completes.
+        """
+        self.handler.write(chunk)
+        if not isinstance(chunk, dict):
+            self.buffered += len(chunk)
+
+        if self.buffered >= self.max_bytes:
+            self.flush()
+        elif self.timeout is None and not self.flushing:
+            self.timeout = schedule_deadline(
+                self.io_loop.time() + self.max_delay, self._expire,
+                self.io_loop, self.timer_wheel, inherit=False)
+
+        # Reused for each write, to save an allocation.
+        return self.drain
+
+    def flush(self):
+        """Flush now, or as soon as the flush in flight completes."""
+        self._remove_timeout()
+        if self.flushing or not self.buffered or self.finished:
+            return
+
+        self.flushing = True
+        self.buffered = 0
+        self.flushes += 1
+        self.handler.flush(callback=self._flushed)
+
+    def finish(self, chunk=None):
+        """Finish the response with the handler's ``finish``."""
+        self._remove_timeout()
+        self.finished = True
+        self.handler.finish(chunk)
+
+    def _expire(self):
+        self.timeout = None
+        self.flush()
+
+    def _flushed(self):
+        self.flushing = False
+        # Output written during the flush has waited long enough.
+        self.flush()
+        waiters, self.waiters = self.waiters, []
+        for wake in waiters:
+            wake()
+
+    def _remove_timeout(self):
+        cancel_deadline(self.timeout)
+        self.timeout = None
+
+
+class _Acquire(gen.YieldPoint):
+    def __init__(self, limiter, tokens):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.key = None
+        self.granted = False
+        self.active = False
+
+    def start(self, runner):
+        if metrics.collector is not None:
+            metrics.started(self)
+        self.runner = runner
+        self.key = None
+        self.active = False
+        self.granted = self.limiter.try_acquire(self.tokens)
+        if self.granted:
+            return
+
+        # Wait under a key, so WithTimeout(..., cancel=True) can withdraw.
+        key = self.key = object()
+        runner.register_callback(key)
+        _result_dict(runner).watchers[key] = self
+        self.callback = stack_context.wrap(runner.result_callback(key))
+        self.active = True
+        self.limiter._enqueue(self)
+
+    def is_ready(self):
+        return self.granted
+
+    def get_result(self):
+        if metrics.collector is not None:
+            metrics.ready(self)
+            metrics.finished(self)
+
+    def key_completed(self, key):
+        self.runner.pop_result(key)
+        self.granted = True
+
+    def key_canceled(self, key):
+        if self.active:
+            self.active = False
+            self.limiter._withdraw(self)
+
+
+class RateLimiter(object):
+    """Limit operations to `rate` per second, with bursts of up to `burst`.
+
+    A token bucket: tokens accrue at `rate` per second, up to `burst`, and
+    each operation takes one. Yield :meth:`acquire` before starting an
+    operation, to wait for a token::
+
+        limiter = yieldpoints.RateLimiter(rate=100, burst=10)
+
+        for url in urls:
+            yield limiter.acquire()
+            client.fetch(url, callback=(yield gen.Callback(url)))
+
+    Waiters get tokens first-come first-served, and a new caller can't take
+    a token while others are waiting. The limiter has a single timeout, for
+    when the first waiter's tokens will have accrued, however many are
+    waiting.
+
+    To give up if no token arrives in time, wrap :meth:`acquire` in
+    :class:`WithTimeout` with ``cancel=True``, which withdraws the waiter
+    when it times out::
+
+        try:
+            yield yieldpoints.WithTimeout(
+                timedelta(seconds=0.1), limiter.acquire(), cancel=True)
+        except yieldpoints.TimeoutException:
+            raise web.HTTPError(503)
+
+    :Parameters:
+      - `rate`: Tokens per second
+      - `burst`: Optional most tokens that can accrue, default 1
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeouts on
+    """
+    def __init__(self, rate, burst=1, io_loop=None, timer_wheel=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.io_loop = io_loop or IOLoop.instance()
+        self.timer_wheel = timer_wheel
+        self.tokens = burst
+        self.updated = self.io_loop.time()
+        self.waiters = deque()
+        self.withdrawn = 0
+        self.timeout = None
+
+    def acquire(self, tokens=1):
+        """A YieldPoint that waits until `tokens` are available, and takes
+        them.
+        """
+        if tokens > self.burst:
+            raise ValueError("can't acquire %r tokens with burst %r" % (
+                tokens, self.burst))
+        return _Acquire(self, tokens)
+
+    def try_acquire(self, tokens=1):
+        """Take `tokens` if they're available and no one is waiting, without
+        waiting. Returns True if they were taken.
+        """
+        if self.waiters:
+            return False
+
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def _refill(self):
+        now = self.io_loop.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _enqueue(self, waiter):
+        self.waiters.append(waiter)
+        if self.timeout is None:
+            self._schedule()
+
+    def _withdraw(self, waiter):
+        if waiter is self.waiters[0]:
+            self.waiters.popleft()
+            self._remove_timeout()
+            self._grant()
+            return
+
+        self.withdrawn += 1
+        if self.withdrawn > 16 + len(self.waiters) // 2:
+            self.waiters = deque(w for w in self.waiters if w.active)
+            self.withdrawn = 0
+
+    def _schedule(self):
+        # Wake when the first waiter's tokens will have accrued.
+        needed = self.waiters[0].tokens - self.tokens
+        self.timeout = schedule_deadline(
+            self.updated + needed / self.rate, self._fire, self.io_loop,
+            self.timer_wheel, inherit=False)
+
+    def _fire(self):
+        self.timeout = None
+        self._grant()
+
+    def _grant(self):
+        self._refill()
+        granted = []
+        waiters = self.waiters
+        while waiters:
+            waiter = waiters[0]
+            if not waiter.active:
+                waiters.popleft()
+                self.withdrawn -= 1
+            elif waiter.tokens <= self.tokens:
+                waiters.popleft()
+                waiter.active = False
+                self.tokens -= waiter.tokens
+                granted.append(waiter)
+            else:
+                break
+
+        if waiters and self.timeout is None:
+            self._schedule()
+
+        # Resume the coroutines last, since they may acquire again.
+        for waiter in granted:
+            waiter.callback(None)
+
+    def _remove_timeout(self):
+        cancel_deadline(self.timeout)
+        self.timeout = None
@@ -0,0 +1,158 @@
+"""Find keys that coroutines register and never wait for or cancel.
+
+A key that's never waited for, canceled, or given a result stays in its
+coroutine's pending callbacks, with its result if it has one, until the
+coroutine finishes. In a long-running coroutine that leaks memory. Enable
+debug mode to record when and where each key is registered, and to log keys
+that stay pending too long::
+
+    from yieldpoints import debug
+
+    debug.enable(threshold=60, interval=10)
+
+Recording a key costs a dict insertion and a look at the coroutine's
+current line, so debug mode can be left on in production canaries. Use
+:func:`snapshot` to list the pending keys at any time.
+"""
+
+from collections import namedtuple
+import logging
+import sys
+import time
+import weakref
+
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger('yieldpoints')
+
+
+class PendingKey(namedtuple('PendingKey',
+                            ['key', 'site', 'age', 'result_size'])):
+    """A pending key, from :func:`snapshot`.
+
+    ``site`` is the ``'filename:line'`` where the coroutine was when it
+    registered the key, ``age`` the seconds since then, and ``result_size``
+    the size in bytes of the key's result, as reported by
+    ``sys.getsizeof``, or None if it has no result yet.
+    """
+    __slots__ = ()
+
+
+default_threshold = 60
+"""Seconds a key may be pending before :func:`leaks` reports it, unless
+another threshold is passed."""
+
+_registry = None
+_register_callback = None
+_periodic = None
+
+
+def enable(threshold=None, interval=None, io_loop=None):
+    """Start recording where keys are registered.
+
+    :Parameters:
+      - `threshold`: Optional seconds to set :data:`default_threshold`
+      - `interval`: Optional seconds between calls to :func:`check`
+      - `io_loop`: Optional custom ``IOLoop`` on which to run :func:`check`
+    """
+    global default_threshold, _registry, _register_callback, _periodic
+    if threshold is not None:
+        default_threshold = threshold
+
+    if _register_callback is None:
+        _registry = weakref.WeakKeyDictionary()
+        _register_callback = gen.Runner.register_callback
+        gen.Runner.register_callback = _record_register_callback
+
+    if interval is not None and _periodic is None:
+        _periodic = PeriodicCallback(check, interval * 1000, io_loop=io_loop)
+        _periodic.start()
+
+
+def disable():
+    """Stop recording, and forget the keys recorded."""
+    global _registry, _register_callback, _periodic
+    if _periodic is not None:
+        _periodic.stop()
+        _periodic = None
+
+    if _register_callback is not None:
+        gen.Runner.register_callback = _register_callback
+        _register_callback = None
+        _registry = None
+
+
+def enabled():
+    """Whether debug mode is on."""
+    return _register_callback is not None
+
+
+def snapshot():
+    """A list of :class:`PendingKey` for every key that's pending in a
+    coroutine that's still running, registered while debug mode was on.
+    """
+    if _registry is None:
+        return []
+
+    now = time.time()
+    pending_keys = []
+    for runner, records in list(_registry.items()):
+        _prune(runner, records)
+        results = runner.results
+        for key, (registered, site) in records.items():
+            if key in results:
+                size = sys.getsizeof(results[key])
+            else:
+                size = None
+            pending_keys.append(PendingKey(key, site, now - registered, size))
+
+    return pending_keys
+
+
+def leaks(threshold=None):
+    """Keys that have been pending for `threshold` seconds or more, by
+    default :data:`default_threshold`.
+    """
+    if threshold is None:
+        threshold = default_threshold
+    return [pending for pending in snapshot() if pending.age >= threshold]
+
+
+def check(threshold=None):
+    """Log a warning for each of :func:`leaks`, and return them."""
+    found = leaks(threshold)
+    for pending in found:
+        if pending.result_size is None:
+            retained = 'no result'
+        else:
+            retained = 'result of %d bytes' % pending.result_size
+        logger.warning(
+            "key %r registered at %s pending for %.1f seconds, %s",
+            pending.key, pending.site, pending.age, retained)
+    return found
+
+
+def _record_register_callback(runner, key):
+    _register_callback(runner, key)
+    records = _registry.get(runner)
+    if records is None:
+        records = _registry[runner] = {}
+    elif len(records) > 2 * len(runner.pending_callbacks) + 16:
+        _prune(runner, records)
+
+    # The coroutine is suspended at the yield that registered the key.
+    frame = getattr(getattr(runner, 'gen', None), 'gi_frame', None)
+    if frame is not None:
+        site = '%s:%d' % (frame.f_code.co_filename, frame.f_lineno)
+    else:
+        site = None
+
+    records[key] = (time.time(), site)
+
+
+def _prune(runner, records):
+    pending = runner.pending_callbacks
+    for key in list(records):
+        if key not in pending:
+            del records[key]
@@ -0,0 +1,198 @@
+"""Versions of :class:`~yieldpoints.WaitAny`,
+:class:`~yieldpoints.WithTimeout`, :class:`~yieldpoints.Cancel` and
+:class:`~yieldpoints.CancelAll` for Futures instead of callback keys.
+
+These work on Tornado ``Futures`` and on ``asyncio`` futures and awaitables.
+Each function returns a Future of the same kind as its arguments: an
+``asyncio`` future on the arguments' event loop if any are ``asyncio``
+futures, otherwise a Tornado ``Future``. Completions are delivered by done
+callbacks, so nothing polls each Future.
+"""
+
+from datetime import timedelta
+import time
+
+from tornado.concurrent import Future
+
+from yieldpoints import TimeoutException
+from yieldpoints.timers import (cancel_deadline, schedule_deadline,
+                                timedelta_to_seconds)
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+def _future(obj):
+    if asyncio is not None and not hasattr(obj, 'add_done_callback'):
+        # A coroutine or other awaitable.
+        return asyncio.ensure_future(obj)
+    return obj
+
+
+def _items(futures):
+    if isinstance(futures, dict):
+        return [(key, _future(f)) for key, f in futures.items()]
+    else:
+        futures = [_future(f) for f in futures]
+        return list(zip(futures, futures))
+
+
+def _asyncio_loop(futures):
+    if asyncio is not None:
+        for f in futures:
+            if isinstance(f, asyncio.Future):
+                return f._loop
+    return None
+
+
+def _new_future(futures):
+    loop = _asyncio_loop(futures)
+    if loop is not None:
+        return loop.create_future()
+    return Future()
+
+
+def _bind(fn, key):
+    return lambda future: fn(key, future)
+
+
+def _copy_result(source, dest, key=None, with_key=False):
+    if source.cancelled():
+        dest.cancel()
+    elif source.exception() is not None:
+        dest.set_exception(source.exception())
+    elif with_key:
+        dest.set_result((key, source.result()))
+    else:
+        dest.set_result(source.result())
+
+
+def wait_any(futures):
+    """Wait for several Futures, and resolve when the first is complete.
+
+    `futures` is a list of Futures or awaitables, or a dict that maps keys to
+    them. Returns a Future that resolves to ``(key, result)`` for the first
+    to complete, where ``key`` is the Future itself if `futures` is a list.
+    If that Future failed its exception is raised instead.
+    """
+    items = _items(futures)
+    if not items:
+        raise ValueError("no futures to wait for")
+
+    wait_future = _new_future([f for _, f in items])
+
+    def done_callback(key, future):
+        if wait_future.done():
+            return
+
+        for other_key, other in items:
+            callback = callbacks.get(other_key)
+            if (other is not future and callback is not None
+                    and hasattr(other, 'remove_done_callback')):
+                other.remove_done_callback(callback)
+
+        _copy_result(future, wait_future, key, with_key=True)
+
+    callbacks = {}
+    for key, future in items:
+        callbacks[key] = _bind(done_callback, key)
+        future.add_done_callback(callbacks[key])
+        if wait_future.done():
+            break
+
+    return wait_future
+
+
+class as_completed(object):
+    """Iterate over Futures that resolve in the order `futures` complete.
+
+    Like :class:`~yieldpoints.AsCompleted`, draining n Futures costs O(n).
+    The k-th Future yielded resolves to ``(key, result)`` for the k-th of
+    `futures` to complete, as with :func:`wait_any`::
+
+        for next_future in yieldpoints.futures.as_completed(futures):
+            key, result = yield next_future
+    """
+    def __init__(self, futures):
+        items = _items(futures)
+        loop = _asyncio_loop([f for _, f in items])
+        if loop is not None:
+            self.results = [loop.create_future() for _ in items]
+        else:
+            self.results = [Future() for _ in items]
+
+        self.n_completed = 0
+        for key, future in items:
+            future.add_done_callback(_bind(self._done_callback, key))
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def _done_callback(self, key, future):
+        result = self.results[self.n_completed]
+        self.n_completed += 1
+        _copy_result(future, result, key, with_key=True)
+
+
+def with_timeout(deadline, future, io_loop=None, timer_wheel=None):
+    """Wait for a Future or a timeout, whichever comes first.
+
+    Returns a Future that resolves like `future`, or raises
+    :class:`~yieldpoints.TimeoutException` at `deadline`. The timeout is
+    removed once `future` completes. An ``asyncio`` future is timed on its
+    own event loop.
+
+    :Parameters:
+      - `deadline`: A timestamp or timedelta
+      - `future`: A Future or awaitable
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeout
+      - `timer_wheel`: Optional :class:`~yieldpoints.TimerWheel` to schedule
+        the timeout on, instead of adding a timeout to the ``IOLoop``
+    """
+    future = _future(future)
+    timeout_future = _new_future([future])
+
+    def expire():
+        if not timeout_future.done():
+            timeout_future.set_exception(TimeoutException())
+
+    loop = _asyncio_loop([future])
+    if loop is not None:
+        if isinstance(deadline, timedelta):
+            delay = timedelta_to_seconds(deadline)
+        else:
+            delay = deadline - time.time()
+        handle = loop.call_later(delay, expire)
+        remove_timeout = handle.cancel
+    else:
+        handle = schedule_deadline(
+            deadline, expire, io_loop, timer_wheel, inherit=False)
+        remove_timeout = lambda: cancel_deadline(handle)
+
+    def done_callback(future):
+        if not timeout_future.done():
+            remove_timeout()
+            _copy_result(future, timeout_future)
+
+    future.add_done_callback(done_callback)
+    return timeout_future
+
+
+def cancel(future):
+    """Cancel a Future that isn't done. Returns True if it was canceled."""
+    return future.cancel()
+
+
+def cancel_all(futures):
+    """Cancel each of `futures` that isn't done."""
+    if isinstance(futures, dict):
+        futures = futures.values()
+
+    for future in futures:
+        if not future.done():
+            future.cancel()
@@ -0,0 +1,210 @@
+"""Instrumentation for yield points.
+
+Install a :class:`Collector` with :func:`set_collector` to be told when each
+yield point starts, becomes ready, returns its result, or times out, and
+when keys are canceled. With no collector installed, each of these costs
+one attribute check::
+
+    collector = metrics.HistogramCollector()
+    metrics.set_collector(collector)
+    ...
+    print(collector.snapshot())
+
+Give a yield point a label to count it separately from others of its type::
+
+    key, result = yield metrics.label(yieldpoints.WaitAny(keys), 'shards')
+"""
+
+import math
+import time
+
+
+collector = None
+"""The installed :class:`Collector`, or None."""
+
+
+def set_collector(new_collector):
+    """Install a :class:`Collector`, or None to stop collecting."""
+    global collector
+    collector = new_collector
+
+
+def label(yield_point, name):
+    """Set a yield point's label, and return it."""
+    yield_point.label = name
+    return yield_point
+
+
+def started(yield_point):
+    yield_point.metrics_start = time.time()
+    collector.start(yield_point)
+
+
+def ready(yield_point):
+    start = getattr(yield_point, 'metrics_start', None)
+    if start is not None:
+        collector.ready(yield_point, time.time() - start)
+
+
+def finished(yield_point, expired=False, winner=None):
+    start = getattr(yield_point, 'metrics_start', None)
+    if start is not None:
+        yield_point.metrics_start = None
+        yield_point.metrics_winner = winner
+        waited = time.time() - start
+        if expired:
+            collector.expire(yield_point, waited)
+        else:
+            collector.result(yield_point, waited)
+
+
+def canceled(runner, key):
+    collector.cancel(runner, key)
+
+
+class Collector(object):
+    """Base class for metrics collectors. Override the events you need.
+
+    `waited` is seconds since the yield point started. When a yield point
+    returns, its ``metrics_winner`` attribute is the key that completed, or
+    a list of keys in the order they completed, if it waits for keys.
+    `runner` is the ``gen.Runner`` of the coroutine that canceled a key.
+    """
+    def start(self, yield_point):
+        pass
+
+    def ready(self, yield_point, waited):
+        pass
+
+    def result(self, yield_point, waited):
+        pass
+
+    def expire(self, yield_point, waited):
+        pass
+
+    def cancel(self, runner, key):
+        pass
+
+
+class Histogram(object):
+    """Count values in logarithmic buckets, like an HDR histogram.
+
+    Each power of two is split into `sub_buckets` equal buckets, so values
+    are reported within ``1 / sub_buckets`` relative error. Memory is
+    proportional to the range of values, not their number.
+
+    :Parameters:
+      - `sub_buckets`: Optional buckets per power of two, default 16
+      - `unit`: Optional smallest distinguishable value, default 1e-6
+    """
+    def __init__(self, sub_buckets=16, unit=1e-6):
+        self.sub_buckets = sub_buckets
+        self.unit = unit
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        mantissa, exponent = math.frexp(max(value, self.unit) / self.unit)
+        index = (exponent * self.sub_buckets
+                 + int((mantissa - 0.5) * 2 * self.sub_buckets))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Approximate value at `percentile`, or None if empty."""
+        if not self.count:
+            return None
+
+        if percentile <= 0:
+            return self.min
+        if percentile >= 100:
+            return self.max
+
+        target = max(1, int(math.ceil(percentile / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                value = self._bucket_value(index)
+                return min(max(value, self.min), self.max)
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def _bucket_value(self, index):
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+        mantissa = 0.5 + (sub_bucket + 0.5) / (2.0 * self.sub_buckets)
+        return math.ldexp(mantissa, exponent) * self.unit
+
+
+class HistogramCollector(Collector):
+    """Keep a :class:`Histogram` of wait times and counts of events, for each
+    yield point type and label.
+    """
+    def __init__(self, sub_buckets=16, unit=1e-6):
+        self.sub_buckets = sub_buckets
+        self.unit = unit
+        self.histograms = {}
+        self.counts = {}
+
+    def start(self, yield_point):
+        self._count(yield_point, 'start')
+
+    def result(self, yield_point, waited):
+        self._count(yield_point, 'result')
+        self._histogram(yield_point).add(waited)
+
+    def expire(self, yield_point, waited):
+        self._count(yield_point, 'expire')
+        self._histogram(yield_point).add(waited)
+
+    def cancel(self, runner, key):
+        event = ('Cancel', None, 'cancel')
+        self.counts[event] = self.counts.get(event, 0) + 1
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """A dict of ``'type'`` or ``'type:label'`` to event counts and wait
+        time percentiles.
+        """
+        result = {}
+        for (type_name, name, event), count in self.counts.items():
+            result.setdefault(self._name(type_name, name), {})[event] = count
+
+        for (type_name, name), histogram in self.histograms.items():
+            stats = result.setdefault(self._name(type_name, name), {})
+            stats['mean'] = histogram.mean()
+            stats['max'] = histogram.max
+            for p in percentiles:
+                stats['p%s' % p] = histogram.percentile(p)
+
+        return result
+
+    def _key(self, yield_point):
+        return type(yield_point).__name__, getattr(yield_point, 'label', None)
+
+    def _name(self, type_name, name):
+        if name is None:
+            return type_name
+        return '%s:%s' % (type_name, name)
+
+    def _count(self, yield_point, event):
+        key = self._key(yield_point) + (event,)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _histogram(self, yield_point):
+        key = self._key(yield_point)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(
+                self.sub_buckets, self.unit)
+        return histogram
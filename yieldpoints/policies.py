@@ -0,0 +1,145 @@
+"""Policies that choose among several ready keys, for
+:class:`~yieldpoints.WaitAny`.
+
+By default ``WaitAny`` returns the first ready key in the order of its
+keys, so when many keys are ready at once the keys at the start of the list
+can starve the rest. With a policy, ``WaitAny`` records completions as they
+arrive in a ready queue, and the policy picks from that queue in O(log n)::
+
+    policy = yieldpoints.RoundRobinPolicy()
+    while keys:
+        key, result = yield yieldpoints.WaitAny(keys, policy=policy)
+        keys.remove(key)
+
+A policy makes a ready queue for a loop's keys, with ``push(key)`` for each
+key that's ready, ``pop()`` to choose one, and ``__len__``. Keys that are
+ready when the queue is made are pushed in the order they completed. The
+queue is kept across the loop's waits, and made again only if the keys
+change other than by losing keys that were returned or canceled.
+"""
+
+from collections import deque
+import heapq
+import itertools
+import random
+
+
+class _FIFOQueue(deque):
+    push = deque.append
+    pop = deque.popleft
+
+
+class FIFOPolicy(object):
+    """Choose the key that completed first.
+
+    Results that arrived before the coroutine first used a
+    :class:`~yieldpoints.Callback` or a yield point that watches keys, such
+    as a ``WaitAny`` with a policy, are taken in the order of the keys.
+    """
+    def queue(self, keys):
+        return _FIFOQueue()
+
+
+class _RandomQueue(list):
+    push = list.append
+
+    def pop(self):
+        i = random.randrange(len(self))
+        self[i], self[-1] = self[-1], self[i]
+        return list.pop(self)
+
+
+class RandomPolicy(object):
+    """Choose a ready key at random."""
+    def queue(self, keys):
+        return _RandomQueue()
+
+
+class _PriorityQueue(object):
+    def __init__(self, priority):
+        self.priority = priority
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, key):
+        heapq.heappush(
+            self.heap, (self.priority(key), next(self.counter), key))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+
+class PriorityPolicy(object):
+    """Choose the ready key with the lowest priority number.
+
+    Keys of equal priority are chosen in the order completed.
+
+    :Parameters:
+      - `priorities`: A dict that maps keys to priorities, or a function
+        that takes a key and returns its priority. Keys missing from the
+        dict have priority 0.
+    """
+    def __init__(self, priorities):
+        if callable(priorities):
+            self.priority = priorities
+        else:
+            self.priority = lambda key: priorities.get(key, 0)
+
+    def queue(self, keys):
+        return _PriorityQueue(self.priority)
+
+
+class _RoundRobinQueue(object):
+    def __init__(self, policy, keys):
+        self.policy = policy
+        self.keys = list(keys)
+        self.positions = dict((key, i) for i, key in enumerate(self.keys))
+        if policy.last_key in self.positions:
+            self.start = self.positions[policy.last_key] + 1
+        else:
+            # The last key was removed, so its successor took its place.
+            self.start = policy.last_index
+
+        # Heaps of ready positions from start onward, and before start.
+        self.current = []
+        self.wrapped = []
+
+    def __len__(self):
+        return len(self.current) + len(self.wrapped)
+
+    def push(self, key):
+        index = self.positions[key]
+        if index >= self.start:
+            heapq.heappush(self.current, index)
+        else:
+            heapq.heappush(self.wrapped, index)
+
+    def pop(self):
+        if not self.current:
+            # Wrap around.
+            self.current, self.wrapped = self.wrapped, self.current
+
+        index = heapq.heappop(self.current)
+        self.start = index + 1
+        key = self.keys[index]
+        self.policy.last_key = key
+        self.policy.last_index = index
+        return key
+
+
+class RoundRobinPolicy(object):
+    """Choose the next ready key after the one chosen last time.
+
+    Keys are taken in turn in the order of the wait's keys, wrapping around,
+    so share one ``RoundRobinPolicy`` among the waits of a loop. If the key
+    chosen last is no longer among the keys, its successor is next.
+    """
+    def __init__(self):
+        self.last_key = None
+        self.last_index = 0
+
+    def queue(self, keys):
+        return _RoundRobinQueue(self, keys)
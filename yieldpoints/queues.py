@@ -0,0 +1,106 @@
+"""A queue for coroutines, with :class:`~yieldpoints.Get` and
+:class:`~yieldpoints.Put` yield points that :class:`~yieldpoints.Select`
+can wait on together::
+
+    q = yieldpoints.Queue(maxsize=10)
+
+    @gen.coroutine
+    def producer():
+        for item in items:
+            yield yieldpoints.Put(q, item)
+
+    @gen.coroutine
+    def consumer():
+        while True:
+            item = yield yieldpoints.Get(q)
+"""
+
+from collections import deque
+
+
+class QueueEmpty(Exception):
+    """Raised by :meth:`Queue.get_nowait` when the queue has no items."""
+
+
+class QueueFull(Exception):
+    """Raised by :meth:`Queue.put_nowait` when the queue is at its maxsize."""
+
+
+class Queue(object):
+    """A first-in first-out queue of items passed between coroutines.
+
+    Coroutines wait to get items with :class:`~yieldpoints.Get`, and to put
+    them with :class:`~yieldpoints.Put` if the queue is full. Waiters are
+    served in the order they began waiting.
+
+    :Parameters:
+      - `maxsize`: Optional maximum number of items, default 0 for no limit
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.items = deque()
+        # Waiting (select, case) pairs. Entries for selects that finished
+        # another way are skipped, and purged when they're the majority.
+        self.getters = deque()
+        self.putters = deque()
+        self.withdrawn_getters = 0
+        self.withdrawn_putters = 0
+
+    def qsize(self):
+        """Number of items in the queue."""
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def put_nowait(self, item):
+        """Put an item, or raise :class:`QueueFull`.
+
+        If a coroutine is waiting to get an item, it's given `item`.
+        """
+        while self.getters:
+            select, case = self.getters.popleft()
+            if select.active:
+                select.finish(case, item)
+                return
+            self.withdrawn_getters -= 1
+
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+
+    def get_nowait(self):
+        """Remove and return an item, or raise :class:`QueueEmpty`.
+
+        If a coroutine is waiting to put an item, its item is added.
+        """
+        if not self.items:
+            raise QueueEmpty()
+
+        item = self.items.popleft()
+        while self.putters:
+            select, case = self.putters.popleft()
+            if select.active:
+                self.items.append(case.item)
+                select.finish(case, None)
+                break
+            self.withdrawn_putters -= 1
+
+        return item
+
+    def _withdraw_getter(self):
+        self.withdrawn_getters += 1
+        if self.withdrawn_getters > 16 + len(self.getters) // 2:
+            self.getters = deque(
+                waiter for waiter in self.getters if waiter[0].active)
+            self.withdrawn_getters = 0
+
+    def _withdraw_putter(self):
+        self.withdrawn_putters += 1
+        if self.withdrawn_putters > 16 + len(self.putters) // 2:
+            self.putters = deque(
+                waiter for waiter in self.putters if waiter[0].active)
+            self.withdrawn_putters = 0
@@ -0,0 +1,311 @@
+"""Shared deadline scheduling for yield points."""
+
+import contextlib
+from datetime import timedelta
+from functools import partial
+import heapq
+import math
+import threading
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+
+def timedelta_to_seconds(td):
+    # timedelta.total_seconds() isn't available until Python 2.7
+    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6
+
+
+class _WheelTimeout(object):
+    __slots__ = ('tick', 'callback')
+
+    def __init__(self, tick, callback):
+        self.tick = tick
+        self.callback = callback
+
+
+class TimerWheel(object):
+    """Schedule many deadlines with few ``IOLoop`` timeouts.
+
+    Deadlines are rounded up to a multiple of `slack` seconds, and all the
+    deadlines in one slot fire together from a single ``IOLoop`` timeout, so
+    a timeout fires at most `slack` seconds late. Only the earliest slot has
+    an ``IOLoop`` timeout at any moment, and
+    :meth:`remove_timeout` is O(1), so canceled deadlines never reach the
+    ``IOLoop``.
+
+    Pass a ``TimerWheel`` to :class:`~yieldpoints.WithTimeout` to share it
+    among many waits.
+
+    :Parameters:
+      - `slack`: Optional granularity in seconds, default 0.01
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeouts
+    """
+    def __init__(self, slack=0.01, io_loop=None):
+        self.slack = slack
+        self.io_loop = io_loop or IOLoop.instance()
+        self.slots = {}
+        self.ticks = []
+        self.queued = set()
+        self.timeout = None
+        self.timeout_tick = None
+        self.wakeups = 0
+        self.n_timeouts = 0
+
+    def __len__(self):
+        """Number of pending timeouts."""
+        return self.n_timeouts
+
+    def add_timeout(self, deadline, callback):
+        """Run `callback` at `deadline`, a timestamp or timedelta.
+
+        Returns a handle that can be passed to :meth:`remove_timeout`.
+        """
+        if isinstance(deadline, timedelta):
+            deadline = self.io_loop.time() + timedelta_to_seconds(deadline)
+
+        tick = int(math.ceil(deadline / self.slack))
+        slot = self.slots.get(tick)
+        if slot is None:
+            slot = self.slots[tick] = set()
+            if tick not in self.queued:
+                self.queued.add(tick)
+                heapq.heappush(self.ticks, tick)
+            if self.timeout_tick is None or tick < self.timeout_tick:
+                self._schedule(tick)
+
+        handle = _WheelTimeout(tick, stack_context.wrap(callback))
+        slot.add(handle)
+        self.n_timeouts += 1
+        return handle
+
+    def remove_timeout(self, handle):
+        """Cancel a pending timeout. Removing a fired timeout is a no-op."""
+        if handle.callback is None:
+            return
+
+        # Marked dead, in case its slot is firing now.
+        handle.callback = None
+        self.n_timeouts -= 1
+        slot = self.slots.get(handle.tick)
+        if slot is not None:
+            slot.discard(handle)
+            if not slot:
+                # The tick stays in the heap until it's reached, unless
+                # dead ticks pile up.
+                del self.slots[handle.tick]
+                if not self.slots:
+                    self._clear()
+                elif len(self.ticks) > 16 + 2 * len(self.slots):
+                    self.ticks = list(self.slots)
+                    heapq.heapify(self.ticks)
+                    self.queued = set(self.ticks)
+
+    def _clear(self):
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+        self.timeout = self.timeout_tick = None
+        self.ticks = []
+        self.queued = set()
+
+    def _schedule(self, tick):
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+
+        self.timeout_tick = tick
+        self.timeout = self.io_loop.add_timeout(tick * self.slack, self._fire)
+
+    def _fire(self):
+        self.wakeups += 1
+        self.timeout = self.timeout_tick = None
+        now = self.io_loop.time()
+        while self.ticks and self.ticks[0] * self.slack <= now:
+            tick = heapq.heappop(self.ticks)
+            self.queued.discard(tick)
+            slot = self.slots.pop(tick, None)
+            if slot:
+                for handle in slot:
+                    callback = handle.callback
+                    if callback is None:
+                        # Removed by an earlier callback in this slot.
+                        continue
+
+                    handle.callback = None
+                    self.n_timeouts -= 1
+                    try:
+                        callback()
+                    except Exception:
+                        self.io_loop.handle_callback_exception(callback)
+
+        # Skip ticks whose timeouts were all removed.
+        while self.ticks and self.ticks[0] not in self.slots:
+            self.queued.discard(heapq.heappop(self.ticks))
+
+        if self.ticks:
+            self._schedule(self.ticks[0])
+
+
+class _DeadlineState(threading.local):
+    def __init__(self):
+        self.deadline = None
+
+
+_state = _DeadlineState()
+
+
+@contextlib.contextmanager
+def _deadline_context(deadline):
+    old_deadline = _state.deadline
+    _state.deadline = deadline
+    try:
+        yield
+    finally:
+        _state.deadline = old_deadline
+
+
+class Deadline(object):
+    """A deadline for a whole request, shared by the waits within it.
+
+    Use :func:`run_with_deadline` to start a coroutine with a ``Deadline``.
+    A :class:`~yieldpoints.WithTimeout` started within that coroutine, or any
+    coroutine it calls, times out at the ``Deadline`` if it's sooner than
+    the ``WithTimeout``'s own deadline. Such waits subscribe to the
+    ``Deadline``'s single timeout instead of adding their own.
+
+    :Parameters:
+      - `deadline`: A timestamp or timedelta
+      - `io_loop`: Optional custom ``IOLoop`` on which to run timeout
+      - `timer_wheel`: Optional :class:`TimerWheel` to schedule timeout on
+    """
+    def __init__(self, deadline, io_loop=None, timer_wheel=None):
+        self.io_loop = io_loop or IOLoop.instance()
+        if isinstance(deadline, timedelta):
+            deadline = self.io_loop.time() + timedelta_to_seconds(deadline)
+        self.deadline = deadline
+        self.timer_wheel = timer_wheel
+        self.timeout = None
+        self.callbacks = {}
+        self.next_handle = 0
+        self.expired = False
+
+    @staticmethod
+    def current():
+        """The ``Deadline`` in effect, or None."""
+        return _state.deadline
+
+    def add_callback(self, callback):
+        """Run `callback` at the deadline.
+
+        Returns a handle that can be passed to :meth:`remove_callback`. If
+        the deadline has passed, `callback` is run now.
+        """
+        if self.expired:
+            callback()
+            return None
+
+        if self.timeout is None:
+            self.timeout = schedule_deadline(
+                self.deadline, self._fire, self.io_loop, self.timer_wheel,
+                inherit=False)
+
+        handle = self.next_handle
+        self.next_handle += 1
+        self.callbacks[handle] = stack_context.wrap(callback)
+        return handle
+
+    def remove_callback(self, handle):
+        """Cancel a callback. The timeout is removed with the last callback.
+        """
+        if self.callbacks.pop(handle, None) is not None and not self.callbacks:
+            cancel_deadline(self.timeout)
+            self.timeout = None
+
+    def _fire(self):
+        self.timeout = None
+        self.expired = True
+        callbacks, self.callbacks = self.callbacks, {}
+        for callback in callbacks.values():
+            try:
+                callback()
+            except Exception:
+                self.io_loop.handle_callback_exception(callback)
+
+
+class _ScheduledDeadline(object):
+    __slots__ = ('deadline', 'inherited', 'scheduler', 'timeout')
+
+    def __init__(self, deadline, inherited, scheduler, timeout):
+        self.deadline = deadline
+        self.inherited = inherited
+        self.scheduler = scheduler
+        self.timeout = timeout
+
+
+def schedule_deadline(deadline, callback, io_loop=None, timer_wheel=None,
+                      inherit=True):
+    """Run `callback` at `deadline`, and return a handle that can be passed
+    to :func:`cancel_deadline`.
+
+    `deadline` is a timestamp or timedelta, or None. If `inherit` is true
+    and the current :class:`Deadline` is sooner, `callback` subscribes to it
+    instead of adding a timeout. Otherwise the timeout is added to
+    `timer_wheel` if given, else to `io_loop`. The handle's ``deadline`` is
+    the timestamp used, and its ``inherited`` is the ``Deadline`` or None.
+    Returns None if there's no deadline at all.
+    """
+    io_loop = io_loop or IOLoop.instance()
+    if isinstance(deadline, timedelta):
+        deadline = io_loop.time() + timedelta_to_seconds(deadline)
+
+    if inherit:
+        inherited = _state.deadline
+        if inherited is not None and (
+                deadline is None or inherited.deadline <= deadline):
+            return _ScheduledDeadline(
+                inherited.deadline, inherited, None,
+                inherited.add_callback(callback))
+
+    if deadline is None:
+        return None
+
+    if timer_wheel is not None:
+        scheduler = timer_wheel
+    else:
+        scheduler = io_loop
+    return _ScheduledDeadline(
+        deadline, None, scheduler, scheduler.add_timeout(deadline, callback))
+
+
+def cancel_deadline(handle):
+    """Cancel a handle from :func:`schedule_deadline`, or do nothing if it's
+    None, has run, or was canceled.
+    """
+    if handle is None:
+        return
+    if handle.inherited is not None:
+        handle.inherited.remove_callback(handle.timeout)
+    else:
+        handle.scheduler.remove_timeout(handle.timeout)
+
+
+def run_with_deadline(deadline, func, *args, **kwargs):
+    """Call `func` with a request-scoped :class:`Deadline`, and return its
+    result.
+
+    `deadline` is a :class:`Deadline`, a timestamp, or a timedelta. If the
+    caller already has a sooner deadline, it is kept instead::
+
+        @gen.coroutine
+        def get(self):
+            response = yield yieldpoints.run_with_deadline(
+                timedelta(seconds=1), self.fetch_everything)
+    """
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+
+    parent = Deadline.current()
+    if parent is not None and parent.deadline <= deadline.deadline:
+        deadline = parent
+
+    with stack_context.StackContext(partial(_deadline_context, deadline)):
+        return func(*args, **kwargs)
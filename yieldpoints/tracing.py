@@ -0,0 +1,264 @@
+"""Trace each wait to a file, and find what set a request's latency.
+
+Install a :class:`TraceCollector` to write a span for each wait, with the
+keys it waited for, the key that completed, and whether it timed out, and
+an instant event for each key canceled. Spans are written in the Chrome
+trace event format, which ``chrome://tracing`` and Perfetto can display::
+
+    metrics.set_collector(tracing.TraceCollector('trace.json'))
+
+Spans are grouped by request. Start each request's coroutine with
+:func:`run_traced` to name it; otherwise each coroutine is its own request::
+
+    @gen.coroutine
+    def get(self):
+        yield tracing.run_traced('search %s' % self.request.uri, self.search)
+
+To see the waits on each request's critical path, and which key ended the
+longest one, run::
+
+    python -m yieldpoints.tracing trace.json
+"""
+
+import contextlib
+from functools import partial
+import json
+import os
+import sys
+import threading
+import time
+
+from tornado import stack_context
+
+from yieldpoints import metrics
+
+
+class _TraceState(threading.local):
+    def __init__(self):
+        self.request = None
+
+
+_state = _TraceState()
+
+
+@contextlib.contextmanager
+def _request_context(request):
+    old_request = _state.request
+    _state.request = request
+    try:
+        yield
+    finally:
+        _state.request = old_request
+
+
+def run_traced(request, func, *args, **kwargs):
+    """Call `func`, and trace its waits and its callees' as `request`."""
+    with stack_context.StackContext(partial(_request_context, request)):
+        return func(*args, **kwargs)
+
+
+class TraceCollector(metrics.Collector):
+    """A :class:`~yieldpoints.metrics.Collector` that writes a span for each
+    wait in Chrome trace event format.
+
+    The file is a JSON array that's left open, as the format allows, so
+    spans are written as they finish. Call :meth:`flush` to read the file
+    while tracing continues, or :meth:`close` to finish it.
+
+    :Parameters:
+      - `trace_file`: A filename or a file object
+      - `max_keys`: Optional number of a span's keys to list, default 20
+    """
+    def __init__(self, trace_file, max_keys=20):
+        if not hasattr(trace_file, 'write'):
+            trace_file = open(trace_file, 'w')
+        self.file = trace_file
+        self.max_keys = max_keys
+        self.pid = os.getpid()
+        self.tids = {}
+        self.file.write('[\n')
+
+    def start(self, yield_point):
+        yield_point.trace_request = _state.request
+
+    def result(self, yield_point, waited):
+        self._span(yield_point, waited, False)
+
+    def expire(self, yield_point, waited):
+        self._span(yield_point, waited, True)
+
+    def cancel(self, runner, key):
+        self._write({
+            'name': 'Cancel', 'ph': 'i', 's': 't',
+            'ts': time.time() * 1e6, 'pid': self.pid,
+            'tid': self._request(None, runner), 'args': {'key': repr(key)}})
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.write('{}]\n')
+        self.file.close()
+
+    def _span(self, yield_point, waited, timed_out):
+        name = type(yield_point).__name__
+        label = getattr(yield_point, 'label', None)
+        if label is not None:
+            name = '%s:%s' % (name, label)
+
+        args = {'timed_out': timed_out}
+        keys = self._keys(yield_point)
+        if keys is not None:
+            args['n_keys'] = len(keys)
+            args['keys'] = [repr(key) for key in keys[:self.max_keys]]
+
+        winner = getattr(yield_point, 'metrics_winner', None)
+        if isinstance(winner, list):
+            args['winner'] = [repr(key) for key in winner]
+        elif winner is not None:
+            args['winner'] = repr(winner)
+
+        now = time.time()
+        request = getattr(yield_point, 'trace_request', None)
+        runner = getattr(yield_point, 'runner', None)
+        self._write({
+            'name': name, 'ph': 'X', 'ts': (now - waited) * 1e6,
+            'dur': waited * 1e6, 'pid': self.pid,
+            'tid': self._request(request, runner), 'args': args})
+
+    def _keys(self, yield_point):
+        inner = getattr(yield_point, 'yield_point', None)
+        if inner is not None:
+            return self._keys(inner)
+
+        key = getattr(yield_point, 'key', None)
+        if key is not None:
+            return [key]
+
+        keys = getattr(yield_point, 'keys', None)
+        if keys is not None:
+            return list(keys)
+        return None
+
+    def _request(self, request, runner):
+        """The thread id for a request's events."""
+        if request is None:
+            request = _state.request
+        if request is None:
+            # One request per coroutine.
+            request = 'coroutine %x' % id(runner)
+
+        tid = self.tids.get(request)
+        if tid is None:
+            if len(self.tids) >= 10000:
+                # Forget old requests; a thread_name event is harmless to
+                # repeat.
+                self.tids.clear()
+            tid = self.tids[request] = hash(request) & 0x7fffffff
+            self._write({
+                'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                'tid': tid, 'args': {'name': str(request)}})
+        return tid
+
+    def _write(self, event):
+        self.file.write(json.dumps(event))
+        self.file.write(',\n')
+
+
+def load(trace_file):
+    """Read the events from a trace file, which may be left open."""
+    with open(trace_file) as f:
+        text = f.read().strip()
+
+    if not text.endswith(']'):
+        text = text.rstrip(',') + ']'
+    return [event for event in json.loads(text) if event]
+
+
+def critical_path(events):
+    """Find the critical path of each request in a list of trace events.
+
+    Returns a dict of each request to the spans, in order, of the longest
+    chain of waits that don't overlap, which ends with the last wait to
+    finish. Waits nested in others, like a ``WaitAny`` in a
+    ``WithTimeout``, are left out.
+    """
+    names = {}
+    requests = {}
+    for event in events:
+        if event.get('ph') == 'M' and event.get('name') == 'thread_name':
+            names[event['tid']] = event['args']['name']
+        elif event.get('ph') == 'X':
+            requests.setdefault(event['tid'], []).append(event)
+
+    paths = {}
+    for request, spans in requests.items():
+        # Outermost spans only: sorted by start, longest first.
+        spans.sort(key=lambda span: (span['ts'], -span['dur']))
+        outer = []
+        end = None
+        for span in spans:
+            span_end = span['ts'] + span['dur']
+            if end is not None and span_end <= end:
+                continue
+            outer.append(span)
+            end = span_end
+
+        # Walk back from the last to finish, through the latest wait that
+        # finished before each began.
+        outer.sort(key=lambda span: span['ts'] + span['dur'])
+        path = []
+        i = len(outer) - 1
+        while i >= 0:
+            span = outer[i]
+            path.append(span)
+            i -= 1
+            while i >= 0 and outer[i]['ts'] + outer[i]['dur'] > span['ts']:
+                i -= 1
+
+        path.reverse()
+        paths[names.get(request, request)] = path
+
+    return paths
+
+
+def _blame(span):
+    winner = span['args'].get('winner')
+    if isinstance(winner, list):
+        # The last key to complete set the latency.
+        winner = winner[-1] if winner else None
+    if span['args'].get('timed_out'):
+        return 'timeout'
+    return winner
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        sys.stderr.write('usage: python -m yieldpoints.tracing TRACE_FILE\n')
+        return 2
+
+    for request, path in sorted(critical_path(load(argv[0])).items(),
+                                key=lambda item: str(item[0])):
+        if not path:
+            continue
+        start = path[0]['ts']
+        total = path[-1]['ts'] + path[-1]['dur'] - start
+        waited = sum(span['dur'] for span in path)
+        print('%s: %.1f ms, %.1f ms waiting' % (
+            request, total / 1000, waited / 1000))
+        for span in path:
+            print('  +%8.1f ms %8.1f ms  %-24s %s' % (
+                (span['ts'] - start) / 1000, span['dur'] / 1000,
+                span['name'], _blame(span)))
+
+        slowest = max(path, key=lambda span: span['dur'])
+        print('  slowest wait: %s, ended by %s' % (
+            slowest['name'], _blame(slowest)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())